@@ -0,0 +1,279 @@
+"""
+进程内的端到端基准测试：middleware -> RequestHandler -> URL处理函数 -> response_factory
+
+用aiohttp的测试客户端直接驱动app，数据库换成内存SQLite，不需要MySQL。
+用法：
+    python -m webapp.test.benchmark                       # 跑一遍并和基线比较
+    python -m webapp.test.benchmark --save-baseline       # 跑3轮，把最慢的一轮保存为基线
+    python -m webapp.test.benchmark -c 20 -n 500 --db-latency 2
+    python -m webapp.test.benchmark --db-latency 5 --fanout 1       # 对比查询串行执行时的延迟
+与基线相比p99变慢或rps下降超过--tolerance时，以非0状态码退出。
+仓库中的benchmark_baseline.json是用默认参数跑出的结果，数字与机器有关：换了机器或CI环境后，
+先在该环境中用默认参数执行一次--save-baseline并提交，之后的运行才能据此判断是否变慢。
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from webapp.www import app as www_app, jobs, orm, passwords
+from webapp.www.config import configs
+from webapp.www.models import User, Blog, Comment, next_id
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+EMAIL = 'bench@example.com'
+PASSWORD = 'benchmark'
+
+
+# 用SQLite实现orm的select/execute，SQL本身不用改：SQLite同样支持`反引号`和?占位符
+def install_sqlite(models, latency=0.0):
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    for model in models:
+        columns = ['`%s` %s' % (name, field.column_type) for name, field in model.__mappings__.items()]
+        db.execute('create table `%s` (%s, primary key (`%s`))' % (
+            model.__table__, ', '.join(columns), model.__primary_key__))
+
+    async def select(sql, args, size=None):
+        if latency:
+            await asyncio.sleep(latency)
+        cur = db.execute(sql, _args(args))
+        rs = cur.fetchmany(size) if size else cur.fetchall()
+        return [dict(r) for r in rs]
+
+    async def execute(sql, args, autocommit=True):
+        if latency:
+            await asyncio.sleep(latency)
+        cur = db.execute(sql, _args(args))
+        db.commit()
+        return cur.rowcount
+
+    async def create_pool(loop, **kw):
+        pass
+
+    orm.select = select
+    orm.execute = execute
+    orm.create_pool = create_pool
+    return db
+
+
+def _args(args):
+    if args is None:
+        return ()
+    if isinstance(args, (list, tuple)):
+        return tuple(args)
+    return (args,)
+
+
+# 浏览器端提交的是sha1(email:password)
+def client_password(email, password):
+    return hashlib.sha1(('%s:%s' % (email, password)).encode('utf-8')).hexdigest()
+
+
+async def seed(blogs=50, comments=20):
+    uid = next_id()
+    user = User(id=uid, email=EMAIL, name='bench', admin=True, image='about:blank',
+                password=await passwords.hash_password(client_password(EMAIL, PASSWORD)))
+    await user.save()
+    blog_ids = []
+    for i in range(blogs):
+        blog = Blog(user_id=uid, user_name=user.name, user_image=user.image, name='Blog %s' % i,
+                    summary='summary %s' % i, content='# Blog %s\n\n' % i + 'Lorem ipsum dolor sit amet. ' * 200,
+                    comment_count=comments)
+        await blog.save()
+        blog_ids.append(blog.id)
+        for j in range(comments):
+            await Comment(blog_id=blog.id, user_id=uid, user_name=user.name, user_image=user.image,
+                          content='comment %s\nline two' % j).save()
+    return blog_ids
+
+
+def scenarios(blog_ids):
+    blog_id = blog_ids[len(blog_ids) // 2]
+    login = dict(email=EMAIL, password=client_password(EMAIL, PASSWORD))
+    return [
+        ('index', 'anon', 'GET', '/', None),
+        ('blog', 'anon', 'GET', '/blog/%s' % blog_id, None),
+        ('api_blogs', 'anon', 'GET', '/api/blogs?page=2', None),
+        ('api_comments', 'anon', 'GET', '/api/comments?page=3', None),
+        ('login', 'anon', 'POST', '/api/authenticate', login),
+        ('comment', 'user', 'POST', '/api/blogs/%s/comments' % blog_id, dict(content='benchmark comment')),
+    ]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+async def run_scenario(client, method, path, body, concurrency, requests):
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            t = time.perf_counter()
+            if method == 'GET':
+                resp = await client.get(path)
+            else:
+                resp = await client.post(path, json=body)
+            await resp.read()
+            latencies.append(time.perf_counter() - t)
+            if resp.status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return dict(p50=percentile(latencies, 50) * 1000, p99=percentile(latencies, 99) * 1000,
+                rps=len(latencies) / elapsed, errors=errors)
+
+
+# 多轮结果合并为最慢的一轮：延迟取大、吞吐取小，错误数累加
+def merge(results, name, r):
+    old = results.get(name)
+    if old is None:
+        results[name] = r
+        return
+    results[name] = dict(p50=max(old['p50'], r['p50']), p99=max(old['p99'], r['p99']),
+                         rps=min(old['rps'], r['rps']), errors=old['errors'] + r['errors'])
+
+
+# /api/batch中的子请求应与直接调用返回相同的状态码和内容
+async def check_batch(client, paths):
+    failures = []
+    resp = await client.post('/api/batch', json=dict(requests=paths))
+    if resp.status != 200:
+        return ['/api/batch: status %s' % resp.status]
+    items = await resp.json()
+    for path, item in zip(paths, items):
+        direct = await client.get(path)
+        body = await direct.json()
+        if item['status'] != direct.status or item['body'] != body:
+            failures.append('%s: batched %s differs from direct %s' % (path, item['status'], direct.status))
+    return failures
+
+
+async def benchmark(loop, args):
+    install_sqlite([User, Blog, Comment], latency=args.db_latency / 1000.0)
+    # 不读写搜索索引的快照文件和任务队列的spool文件
+    configs.search.snapshot = None
+    configs.jobs.spool = None
+    configs.db.fanout = args.fanout
+    # SQLite 3.25以上支持count(*) over()
+    configs.db.window_functions = True
+    app = await www_app.init_app(loop)
+    blog_ids = await seed(args.blogs, args.comments)
+    # 等写入数据时提交的索引任务执行完，不计入压测
+    await jobs.join()
+    anon = TestClient(TestServer(app, loop=loop), loop=loop)
+    await anon.start_server()
+    user = TestClient(anon.server, loop=loop)
+    resp = await user.post('/api/authenticate', json=dict(email=EMAIL, password=client_password(EMAIL, PASSWORD)))
+    assert resp.status == 200, 'login failed: %s' % resp.status
+    clients = dict(anon=anon, user=user)
+    results = {}
+    # 保存基线时多跑几轮，每个场景取最慢的一轮，避免一次偶然偏快的结果让之后的运行都被判为变慢
+    rounds = args.baseline_rounds if args.save_baseline else 1
+    try:
+        failures = await check_batch(user, ['/api/blogs', '/api/blogs?page=2', '/api/blogs/%s' % blog_ids[0],
+                                            '/api/comments'])
+        for _ in range(rounds):
+            for name, who, method, path, body in scenarios(blog_ids):
+                if args.only and name not in args.only:
+                    continue
+                # 预热一次，避免把首次渲染、模板编译算进去
+                await run_scenario(clients[who], method, path, body, 1, 1)
+                merge(results, name,
+                      await run_scenario(clients[who], method, path, body, args.concurrency, args.requests))
+            # 登录（慢速KDF）和首页混合压测，确认口令哈希不会拖慢其它请求
+            if not args.only or 'mixed' in args.only:
+                named = {s[0]: s for s in scenarios(blog_ids)}
+                mixed = await asyncio.gather(*[
+                    run_scenario(clients[who], method, path, body, args.concurrency, args.requests)
+                    for _, who, method, path, body in (named['login'], named['index'])])
+                merge(results, 'mixed_login', mixed[0])
+                merge(results, 'mixed_index', mixed[1])
+    finally:
+        await user.close()
+        await anon.close()
+    return results, failures
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if r['p99'] > base['p99'] * (1 + tolerance):
+            failures.append('%s: p99 %.2fms > baseline %.2fms' % (name, r['p99'], base['p99']))
+        if r['rps'] < base['rps'] * (1 - tolerance):
+            failures.append('%s: rps %.0f < baseline %.0f' % (name, r['rps'], base['rps']))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='in-process benchmark of the request pipeline')
+    parser.add_argument('-c', '--concurrency', type=int, default=10)
+    parser.add_argument('-n', '--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--blogs', type=int, default=50)
+    parser.add_argument('--comments', type=int, default=20, help='comments per blog')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='simulated latency per query (ms)')
+    parser.add_argument('--fanout', type=int, default=configs.db.get('fanout', 4),
+                        help='concurrent queries per request, 1 runs them sequentially')
+    parser.add_argument('--only', nargs='*', help='scenario names to run')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--baseline-rounds', type=int, default=3,
+                        help='rounds to run when saving a baseline, the slowest one is saved')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression ratio')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    results, check_failures = loop.run_until_complete(benchmark(loop, args))
+    for name, r in results.items():
+        print('%-14s p50 %8.2f ms  p99 %8.2f ms  %8.0f req/s  errors %s' % (
+            name, r['p50'], r['p99'], r['rps'], r['errors']))
+
+    errors = ['%s: %s failed requests' % (name, r['errors']) for name, r in results.items() if r['errors']]
+    errors.extend(check_failures)
+    for line in errors:
+        print('ERROR ' + line)
+    if args.save_baseline:
+        # 有失败请求时的数字不能作为基线
+        if errors:
+            print('baseline not saved: some requests failed')
+            return 1
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('baseline saved to %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('no baseline at %s, run with --save-baseline first' % args.baseline)
+        return 1 if errors else 0
+    with open(args.baseline) as f:
+        failures = compare(results, json.load(f), args.tolerance)
+    for line in failures:
+        print('REGRESSION ' + line)
+    return 1 if failures or errors else 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
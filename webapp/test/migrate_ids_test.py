@@ -0,0 +1,63 @@
+"""
+migrate_ids的回归测试：数据库换成内存SQLite，不需要MySQL。
+用法：
+    python -m pytest webapp/test/migrate_ids_test.py
+"""
+
+import asyncio
+
+from webapp.test.benchmark import install_sqlite
+from webapp.www import handlers, migrate_ids
+from webapp.www.models import User, ID_EPOCH
+
+
+def _migrate_user(created_at):
+    db = install_sqlite([User])
+    db.execute('alter table `users` add column `new_id` bigint null')
+    db.execute('insert into `users` (`id`, `email`, `password`, `admin`, `name`, `image`, `created_at`) '
+               'values (?, ?, ?, ?, ?, ?, ?)',
+               ['001500000000000' + 'a' * 32 + '000', 'old@example.com', 'sha1$x$' + '0' * 40, 0, 'old',
+                'about:blank', created_at])
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(migrate_ids.assign_ids('users', False))
+        db.execute('update `users` set `id`=`new_id`')
+        return loop, db.execute('select `id` from `users`').fetchone()['id']
+    except Exception:
+        loop.close()
+        raise
+
+
+# 2017年的旧数据早于2020年，迁移出来的ID必须仍是正数，cookie才能按'-'拆回3段
+def test_pre_2020_row_gets_positive_id_and_valid_cookie():
+    loop, new_id = _migrate_user(1500000000.0)
+    try:
+        assert new_id > 0
+        user = loop.run_until_complete(User.find(str(new_id)))
+        cookie = handlers.user2cookie(user, 3600)
+        assert len(cookie.split('-')) == 3
+        assert loop.run_until_complete(handlers.cookie2user(cookie)) is not None
+    finally:
+        loop.close()
+
+
+# 改写口令哈希之前必须先加宽password列
+def test_password_column_is_widened_before_rewrite():
+    sql = migrate_ids.prepare_sql()
+    assert 'alter table `users` modify `password` varchar(200) not null' in sql
+    assert any('sha1$' in s for s in migrate_ids.foreign_key_sql())
+
+
+def test_rows_before_epoch_are_refused():
+    try:
+        _migrate_user((ID_EPOCH - 1000) / 1000)
+    except ValueError:
+        return
+    raise AssertionError('assign_ids accepted a row created before ID_EPOCH')
+
+
+if '__main__' == __name__:
+    test_pre_2020_row_gets_positive_id_and_valid_cookie()
+    test_password_column_is_widened_before_rewrite()
+    test_rows_before_epoch_are_refused()
+    print('ok')
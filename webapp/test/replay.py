@@ -0,0 +1,254 @@
+"""
+按真实访问日志回放流量，用于容量规划：比较连接池大小、worker数、缓存配置下各路由的延迟和饱和点
+
+日志可以是configs.access_log记录的JSON行，也可以是logger_factory输出的"Request: GET /path"行
+（行内带有asctime时间戳时按原始时间间隔回放，否则按--rate均匀发送）。
+请求按计划时间发出，不等待前一个请求完成（开环），延迟从计划发送时间算起，服务端排队的时间也计算在内。
+用法：
+    python -m webapp.test.replay access.log --seed                   # 按日志中出现的ID向configs.db写入测试数据
+    python -m webapp.test.replay access.log --url http://127.0.0.1:9000 --speed 1,2,4,8 --slo 200
+只回放GET请求和已知的写请求（登录、评论），写请求的内容是生成的；其它POST请求跳过并计数。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sys
+import time
+from datetime import datetime
+
+import aiohttp
+
+from webapp.test.benchmark import EMAIL, PASSWORD, client_password, percentile
+from webapp.www import orm, passwords
+from webapp.www.config import configs
+from webapp.www.models import User, Blog, Comment
+
+_RE_REQUEST = re.compile(r'Request: ([A-Z]+) (\S+)')
+_RE_ASCTIME = re.compile(r'(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})(?:[,.](\d+))?')
+_RE_BLOG_ID = re.compile(r'/blogs?/(\d+)|[?&]id=(\d+)')
+_RE_NUMBER = re.compile(r'/\d+(?=/|$)')
+
+# 可以生成请求内容的写请求：路由模板 -> 函数(path) -> JSON
+WRITES = {
+    '/api/authenticate': lambda path: dict(email=EMAIL, password=client_password(EMAIL, PASSWORD)),
+    '/api/blogs/{id}/comments': lambda path: dict(content='replayed comment'),
+}
+
+
+def _route(path):
+    return _RE_NUMBER.sub('/{id}', path.split('?', 1)[0])
+
+
+def _asctime(line):
+    m = _RE_ASCTIME.search(line)
+    if m is None:
+        return None
+    t = datetime.strptime(m.group(1).replace('T', ' '), '%Y-%m-%d %H:%M:%S').timestamp()
+    if m.group(2):
+        t += float('0.' + m.group(2))
+    return t
+
+
+# 解析日志，返回[(ts, method, path, route, user)]，ts为None表示日志中没有时间
+def parse_log(lines):
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            entries.append((r.get('ts'), r['method'], r['path'], r.get('route') or _route(r['path']),
+                            bool(r.get('user'))))
+            continue
+        m = _RE_REQUEST.search(line)
+        if m is not None:
+            method, path = m.groups()
+            entries.append((_asctime(line), method, path, _route(path), False))
+    return entries
+
+
+# 计算每个请求相对于第一个请求的发送时间(秒)
+def schedule(entries, rate):
+    if entries and all(e[0] is not None for e in entries):
+        # 访问日志在请求结束时写入，按开始时间重新排序
+        entries = sorted(entries, key=lambda e: e[0])
+        t0 = entries[0][0]
+        return [(e[0] - t0,) + e[1:] for e in entries]
+    return [(i / rate,) + e[1:] for i, e in enumerate(entries)]
+
+
+# 日志中引用的blog id，回放前需要存在
+def referenced_blog_ids(entries):
+    ids = set()
+    for e in entries:
+        for m in _RE_BLOG_ID.finditer(e[2]):
+            ids.add(int(m.group(1) or m.group(2)))
+    return ids
+
+
+async def seed(loop, blog_ids, blogs, comments):
+    await orm.create_pool(loop=loop, **configs.db)
+    try:
+        user = await User.find_all('email=?', [EMAIL])
+        if user:
+            user = user[0]
+        else:
+            user = User(email=EMAIL, name='replay', admin=True, image='about:blank',
+                        password=await passwords.hash_password(client_password(EMAIL, PASSWORD)))
+            await user.save()
+        # 日志中出现的blog用原来的id，再补充一些让首页和分页有内容
+        wanted = [dict(id=i) for i in sorted(blog_ids)] + [dict() for _ in range(blogs)]
+        created = 0
+        for i, kw in enumerate(wanted):
+            if 'id' in kw and await Blog.find(kw['id'], cache=False) is not None:
+                continue
+            blog = Blog(user_id=user.id, user_name=user.name, user_image=user.image, name='Replay blog %s' % i,
+                        summary='summary %s' % i,
+                        content='# Replay blog %s\n\n' % i + 'Lorem ipsum dolor sit amet. ' * 200,
+                        comment_count=comments, **kw)
+            await blog.save()
+            created += 1
+            for j in range(comments):
+                await Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image,
+                              content='comment %s\nline two' % j).save()
+        print('seeded %s blogs with %s comments each' % (created, comments))
+    finally:
+        await orm.close_pool()
+
+
+async def replay(url, requests, speed, timeout):
+    connector = aiohttp.TCPConnector(limit=0)
+    results = []
+    skipped = 0
+    async with aiohttp.ClientSession(connector=connector) as anon, \
+            aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as user:
+        resp = await user.post(url + '/api/authenticate', json=WRITES['/api/authenticate'](None))
+        if resp.status != 200:
+            raise RuntimeError('login failed: %s, run with --seed first' % resp.status)
+        await resp.release()
+
+        async def send(at, method, path, route, logged_in):
+            # 写请求都需要登录
+            client = user if logged_in or method != 'GET' else anon
+            t = time.perf_counter()
+            status = 0
+            try:
+                if method == 'GET':
+                    resp = await client.get(url + path, allow_redirects=False, timeout=timeout)
+                else:
+                    resp = await client.post(url + path, json=WRITES[route](path), timeout=timeout)
+                await resp.read()
+                status = resp.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            # 从计划发送时间开始计算，发送被推迟的时间也算在延迟里
+            results.append((route, time.perf_counter() - start - at, status, t - start - at))
+
+        tasks = []
+        start = time.perf_counter()
+        for at, method, path, route, logged_in in requests:
+            if method != 'GET' and route not in WRITES:
+                skipped += 1
+                continue
+            at = at / speed
+            delay = at - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(at, method, path, route, logged_in)))
+        sent = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return results, skipped, sent, elapsed
+
+
+def summarize(results, sent, elapsed):
+    routes = {}
+    for route, latency, status, _ in results:
+        routes.setdefault(route, []).append((latency, status))
+    report = {}
+    for route, rs in routes.items():
+        latencies = [l for l, _ in rs]
+        report[route] = dict(count=len(rs), errors=sum(1 for _, s in rs if s == 0 or s >= 500),
+                             p50=percentile(latencies, 50) * 1000, p90=percentile(latencies, 90) * 1000,
+                             p99=percentile(latencies, 99) * 1000, max=max(latencies) * 1000)
+    latencies = [r[1] for r in results]
+    total = dict(count=len(results), errors=sum(r['errors'] for r in report.values()),
+                 offered_rps=len(results) / sent if sent else 0.0, achieved_rps=len(results) / elapsed,
+                 p50=percentile(latencies, 50) * 1000, p99=percentile(latencies, 99) * 1000,
+                 send_lag=max([r[3] for r in results] or [0]) * 1000)
+    return report, total
+
+
+def print_report(speed, report, total, skipped):
+    print('== speed x%s: offered %.1f req/s, achieved %.1f req/s, p50 %.1f ms, p99 %.1f ms, errors %s, '
+          'skipped %s' % (speed, total['offered_rps'], total['achieved_rps'], total['p50'], total['p99'],
+                          total['errors'], skipped))
+    for route, r in sorted(report.items(), key=lambda kv: -kv[1]['count']):
+        print('  %-32s n %6s  p50 %8.1f  p90 %8.1f  p99 %8.1f  max %8.1f ms  errors %s' % (
+            route, r['count'], r['p50'], r['p90'], r['p99'], r['max'], r['errors']))
+
+
+# 饱和点：第一个p99超过SLO、出现错误，或实际吞吐明显低于发送速率的倍速
+def saturation(totals, slo):
+    for speed, total in totals:
+        if total['p99'] > slo or total['errors'] or total['achieved_rps'] < total['offered_rps'] * 0.9:
+            return speed
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='replay access logs against a running server')
+    parser.add_argument('log', help='access log file, JSON lines or logger_factory output')
+    parser.add_argument('--url', default='http://%s:%s' % (configs.server.host, configs.server.port))
+    parser.add_argument('--speed', default='1', help='comma separated rate multipliers, e.g. 1,2,4,8')
+    parser.add_argument('--rate', type=float, default=50.0, help='req/s when the log has no timestamps')
+    parser.add_argument('--limit', type=int, default=0, help='replay only the first N requests')
+    parser.add_argument('--slo', type=float, default=500.0, help='p99 latency (ms) considered saturated')
+    parser.add_argument('--timeout', type=float, default=30.0, help='per request timeout (s)')
+    parser.add_argument('--seed', action='store_true', help='write the blogs referenced by the log to configs.db')
+    parser.add_argument('--blogs', type=int, default=50, help='extra blogs to seed')
+    parser.add_argument('--comments', type=int, default=20, help='comments per seeded blog')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    with open(args.log, encoding='utf-8') as f:
+        entries = parse_log(f)
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print('no requests found in %s' % args.log)
+        return 1
+    loop = asyncio.get_event_loop()
+    if args.seed:
+        loop.run_until_complete(seed(loop, referenced_blog_ids(entries), args.blogs, args.comments))
+    requests = schedule(entries, args.rate)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    totals = []
+    output = {}
+    for speed in [float(s) for s in args.speed.split(',')]:
+        results, skipped, sent, elapsed = loop.run_until_complete(replay(args.url, requests, speed, timeout))
+        report, total = summarize(results, sent, elapsed)
+        print_report(speed, report, total, skipped)
+        totals.append((speed, total))
+        output[str(speed)] = dict(total=total, routes=report)
+    point = saturation(totals, args.slo)
+    if point is None:
+        print('not saturated up to x%s' % totals[-1][0])
+    else:
+        print('saturated at x%s (%.1f req/s offered)' % (point, dict(totals)[point]['offered_rps']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(speeds=output, saturation=point), f, indent=2, sort_keys=True)
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
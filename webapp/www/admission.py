@@ -0,0 +1,186 @@
+"""
+准入控制：在请求抢占数据库连接之前限制并发，排队有上限、有超时，队列满时快速返回503
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiohttp import web
+
+from webapp.www.config import configs
+from webapp.www.coroweb import route_of, route_option
+
+# 优先级类别，数值越小越优先；写请求排在读请求前面，读请求再多也饿不死写请求
+PRIORITIES = {
+    'write': 0,
+    'read': 1,
+    'background': 2,
+}
+
+
+class QueueFull(Exception):
+    pass
+
+
+# 一个带优先级等待队列的信号量
+class Gate(object):
+    def __init__(self, name, limit, max_queue, timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        # 等待队列：(priority, seq, future)
+        self._waiters = []
+        self._seq = itertools.count()
+
+    @property
+    def depth(self):
+        return len(self._waiters)
+
+    async def acquire(self, priority):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue and not self._evict(priority):
+            self.rejected += 1
+            raise QueueFull(self.name)
+        fut = asyncio.get_event_loop().create_future()
+        entry = (priority, next(self._seq), fut)
+        heapq.heappush(self._waiters, entry)
+        self.max_depth = max(self.max_depth, len(self._waiters))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+        except asyncio.TimeoutError:
+            self._discard(entry)
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                # 超时的同时恰好被放行，把名额还回去
+                self.release()
+            self.timeouts += 1
+            raise QueueFull(self.name)
+        except asyncio.CancelledError:
+            self._discard(entry)
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release()
+            raise
+        finally:
+            self.wait_time += time.monotonic() - start
+        self.admitted += 1
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                # 名额直接交给下一个等待者，active不变
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    # 队列已满时，优先级更高的请求挤掉队列中优先级最低、最晚到达的等待者
+    def _evict(self, priority):
+        if not self._waiters:
+            return False
+        victim = max(self._waiters)
+        if victim[0] <= priority:
+            return False
+        self._discard(victim)
+        victim[2].set_exception(QueueFull(self.name))
+        self.rejected += 1
+        return True
+
+    def _discard(self, entry):
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+
+    def stats(self):
+        return dict(limit=self.limit, active=self.active, queued=self.depth, max_queued=self.max_depth,
+                    max_queue=self.max_queue, admitted=self.admitted, rejected=self.rejected,
+                    timeouts=self.timeouts, wait_seconds=self.wait_time)
+
+
+_gates = {}
+
+
+def _config():
+    return configs.get('admission', {})
+
+
+# 路由级闸门的名字是"方法 路由模板"，配置中没有这一项时再找只写了路由模板的
+def get_gate(name):
+    gate = _gates.get(name)
+    if gate is None:
+        conf = _config()
+        route_conf = None
+        if name != '*':
+            routes = conf.get('routes', {})
+            route_conf = routes.get(name, routes.get(name.partition(' ')[2]))
+        if name != '*' and route_conf is None:
+            return None
+        if name == '*':
+            route_conf = conf
+        gate = Gate(name, route_conf.get('limit', conf.get('limit', 20)),
+                    route_conf.get('queue', conf.get('queue', 100)),
+                    route_conf.get('timeout', conf.get('timeout', 2.0)))
+        _gates[name] = gate
+    return gate
+
+
+def gate_name(request):
+    return '%s %s' % (request.method, route_of(request))
+
+
+def stats():
+    return {name: gate.stats() for name, gate in _gates.items()}
+
+
+def get_priority(request):
+    priority = route_option(request, '__priority__')
+    if priority is None:
+        priority = 'read' if request.method in ('GET', 'HEAD') else 'write'
+    return PRIORITIES.get(priority, PRIORITIES['read'])
+
+
+def _service_unavailable(gate):
+    retry_after = str(_config().get('retry_after', 1))
+    logging.warning('admission: queue full for %s, rejecting request' % gate)
+    return web.Response(status=503, headers={'Retry-After': retry_after}, text='Service busy, retry later.')
+
+
+# 准入控制的middleware，先过路由级的闸门，再过全局闸门
+async def admission_factory(app, handler):
+    async def admission(request):
+        if not _config().get('enabled', True) or request.path.startswith('/static/'):
+            return await handler(request)
+        priority = get_priority(request)
+        # /api/batch的子请求只过路由级的闸门，全局闸门已经由外层请求占用，再申请可能互相等待
+        if getattr(request, '__sub_request__', False):
+            gates = [g for g in (get_gate(gate_name(request)),) if g is not None]
+        else:
+            gates = [g for g in (get_gate(gate_name(request)), get_gate('*')) if g is not None]
+        acquired = []
+        try:
+            for gate in gates:
+                try:
+                    await gate.acquire(priority)
+                except QueueFull:
+                    return _service_unavailable(gate.name)
+                acquired.append(gate)
+            return await handler(request)
+        finally:
+            for gate in reversed(acquired):
+                gate.release()
+
+    return admission
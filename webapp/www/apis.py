@@ -28,7 +28,7 @@ class APIResourceNotFoundError(APIError):
         super(APIResourceNotFoundError, self).__init__('value:notfound', field, message)
 
 
-class APIPermissionError(object):
+class APIPermissionError(APIError):
     """
     Indicate the api has no permission.
     """
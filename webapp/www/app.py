@@ -1,17 +1,23 @@
 import asyncio
+import contextlib
+import hashlib
 import json
 import logging
 import os
+import sys
 import time
 from datetime import datetime
 
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
-from webapp.www import orm
+from webapp.www import jobs, metrics, orm, syndication
+from webapp.www.admission import admission_factory
 from webapp.www.config import configs
-from webapp.www.coroweb import add_routes, add_static
-from webapp.www.handlers import COOKIE_NAME, cookie2user
+from webapp.www.coroweb import add_routes, add_static, route_of, route_option
+from webapp.www.fragments import FragmentCacheExtension
+from webapp.www.handlers import COOKIE_NAME, cookie2user, markdown, text2html
+from webapp.www.models import check_worker_id
 
 
 # 初始化jinja2
@@ -39,7 +45,7 @@ def init_jinja2(app, **kw):
     logging.info('set jinja2 template path: %s' % path)
     # Environment类是jinja2的核心类，用来保存配置、全局对象以及模板文件的路径、过滤器
     # FileSystemLoader(path)加载模板文件
-    env = Environment(loader=FileSystemLoader(path), **options)
+    env = Environment(loader=FileSystemLoader(path), extensions=kw.get('extensions', ()), **options)
     # 得到设置的过滤器dict
     filters = kw.get('filters', None)
     if filters is not None:
@@ -66,11 +72,43 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
+access_logger = logging.getLogger('webapp.access')
+
+
+# 打开结构化访问日志：每行一个JSON对象，记录请求时间、路由、状态码和耗时
+def init_access_log(conf):
+    path = conf.get('path')
+    if not path or access_logger.handlers:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    access_logger.addHandler(handler)
+    access_logger.setLevel(logging.INFO)
+    access_logger.propagate = False
+
+
 # 输出日志的middleware
 async def logger_factory(app, handler):
     async def logger(request):
         logging.info('Request: %s %s' % (request.method, request.path))
-        return await handler(request)
+        if not access_logger.handlers:
+            return await handler(request)
+        ts = time.time()
+        start = time.perf_counter()
+        status = 500
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            access_logger.info(json.dumps(dict(
+                ts=round(ts, 6), method=request.method, path=request.path_qs, route=route_of(request),
+                status=status, ms=round((time.perf_counter() - start) * 1000, 3),
+                user=getattr(request, '__user__', None) is not None)))
 
     return logger
 
@@ -96,76 +134,215 @@ async def auth_factory(app, handler):
     return auth
 
 
+# 将URL处理函数的返回值r构造为web.Response对象
+def make_response(app, request, r):
+    # StreamResponse是所有Response对象的父类，直接返回
+    if isinstance(r, web.StreamResponse):
+        return r
+    if isinstance(r, bytes):
+        # 构造http响应内容
+        resp = web.Response(body=r)
+        resp.content_type = 'application/octet-stream'
+        return resp
+    if isinstance(r, str):
+        # 如果是重定向
+        if r.startswith('redirect:'):
+            # 重定向至目标URL
+            return web.HTTPFound(r[9:])
+        resp = web.Response(body=r.encode('utf-8'))
+        resp.content_type = 'text/html;charset=utf-8'
+        return resp
+    if isinstance(r, dict):
+        # 在后续构造视图函数返回值时，会加入__template__值，用以选择渲染的模板
+        template = r.get('__template__')
+        if template is None:
+            resp = web.Response(
+                # dumps将对象转换成JSON串，目前是处理rest api的情况
+                # ensure_ascii默认值为True，代表仅输出ascii字符，所以改为False
+                # default=lambda obj: obj.__dict__，定义dumps()把r的对象转换成JSON串的规则，因为默认不知道如何转换
+                body=json.dumps(r, ensure_ascii=False, default=lambda obj: obj.__dict__).encode('utf-8'))
+            resp.content_type = 'application/json;charset=utf-8'
+            return resp
+        else:
+            r['__user__'] = request.__user__
+            # app['__templating__']获取jinja2中初始化的Environment对象，调用get_template()方法返回Template对象
+            # 调用Template对象的render()方法，传入r渲染模板，返回unicode格式字符串，将其用utf-8编码，一气呵成，太炫了
+            resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+            resp.content_type = 'text/html;charset=utf-8'
+            return resp
+    # 返回响应码
+    if isinstance(r, int) and 100 <= r < 600:
+        return web.Response(status=r)
+    # 返回了一组响应代码和原因，如：(200, 'OK'), (404, 'Not Found')
+    if isinstance(r, tuple) and len(r) == 2:
+        status_code, message = r
+        if isinstance(status_code, int) and 100 <= status_code < 600:
+            return web.Response(status=status_code, text=str(message))
+    # 不符合以上情况
+    resp = web.Response(body=str(r).encode('utf-8'))
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
+
+
+# 本进程的标识：不使用共享缓存时表版本号只在本进程内有效，ETag不能在worker之间通用
+_instance = '%s.%s' % (os.getpid(), time.time())
+
+
+# 由请求、当前用户和所依赖的表的版本号生成ETag，不访问数据库
+# 不使用共享缓存时其它worker的写入不会改变本进程的版本号，按etag.max_age分段，让ETag定期失效
+def request_etag(request, tables):
+    versions = [orm.table_version(t) for t in tables]
+    user = request.__user__.id if request.__user__ is not None else None
+    if orm.get_shared_cache() is None:
+        scope = (_instance, int(time.time() // configs.get('etag', {}).get('max_age', 30)))
+    else:
+        scope = None
+    key = repr((request.path_qs, user, versions, scope))
+    return 'W/"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+
+def etag_matches(request, etag):
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    return any(tag.strip() in (etag, '*') for tag in header.split(','))
+
+
+def _cache_headers(request, etag):
+    headers = {}
+    cache_control = route_option(request, '__cache_control__')
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if etag:
+        headers['ETag'] = etag
+    return headers
+
+
 # 处理URL处理函数返回值，构造web.Response对象返回
 # handler就是RequestHandler对象
 async def response_factory(app, handler):
     async def response(request):
         logging.info('Response handler...')
+        etag = None
+        if request.method in ('GET', 'HEAD'):
+            tables = route_option(request, '__etag__')
+            if tables:
+                etag = request_etag(request, tables)
+                # 依赖的表没有写入过，不执行URL处理函数，也不查询数据库
+                if etag_matches(request, etag):
+                    return web.Response(status=304, headers=_cache_headers(request, etag))
+        start = time.perf_counter()
         # 会去执行RequestHandler的__call__，拿到response，进一步构造web.Response
         r = await handler(request)
-        # StreamResponse是所有Response对象的父类，直接返回
-        if isinstance(r, web.StreamResponse):
-            return r
-        if isinstance(r, bytes):
-            # 构造http响应内容
-            resp = web.Response(body=r)
-            resp.content_type = 'application/octet-stream'
-            return resp
-        if isinstance(r, str):
-            # 如果是重定向
-            if r.startswith('redirect:'):
-                # 重定向至目标URL
-                return web.HTTPFound(r[9:])
-            resp = web.Response(body=r.encode('utf-8'))
-            resp.content_type = 'text/html;charset=utf-8'
-            return resp
-        if isinstance(r, dict):
-            # 在后续构造视图函数返回值时，会加入__template__值，用以选择渲染的模板
-            template = r.get('__template__')
-            if template is None:
-                resp = web.Response(
-                    # dumps将对象转换成JSON串，目前是处理rest api的情况
-                    # ensure_ascii默认值为True，代表仅输出ascii字符，所以改为False
-                    # default=lambda obj: obj.__dict__，定义dumps()把r的对象转换成JSON串的规则，因为默认不知道如何转换
-                    body=json.dumps(r, ensure_ascii=False, default=lambda obj: obj.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
-            else:
-                r['__user__'] = request.__user__
-                # app['__templating__']获取jinja2中初始化的Environment对象，调用get_template()方法返回Template对象
-                # 调用Template对象的render()方法，传入r渲染模板，返回unicode格式字符串，将其用utf-8编码，一气呵成，太炫了
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
-                return resp
-        # 返回响应码
-        if isinstance(r, int) and 100 <= r < 600:
-            return web.Response(status=r)
-        # 返回了一组响应代码和原因，如：(200, 'OK'), (404, 'Not Found')
-        if isinstance(r, tuple) and len(r) == 2:
-            status_code, message = r
-            if isinstance(status_code, int) and 100 <= status_code < 600:
-                return web.Response(status=status_code, text=str(message))
-        # 不符合以上情况
-        resp = web.Response(body=str(r).encode('utf-8'))
-        resp.content_type = 'text/plain;charset=utf-8'
+        built = time.perf_counter()
+        metrics.observe_handler(request, built - start)
+        resp = make_response(app, request, r)
+        # 模板渲染、JSON序列化的耗时单独统计
+        metrics.observe_render(request, time.perf_counter() - built)
+        # 出错的响应不设置缓存相关的头
+        if resp.status == 200 and not (isinstance(r, dict) and 'error' in r):
+            resp.headers.update(_cache_headers(request, etag))
         return resp
 
     return response
 
 
+# 记录启动各阶段耗时，--check-startup时打印
+class StartupTimer(object):
+    def __init__(self):
+        self.phases = []
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - t))
+
+    def report(self):
+        lines = ['%-24s %8.1f ms' % (name, cost * 1000) for name, cost in self.phases]
+        lines.append('%-24s %8.1f ms' % ('total', (time.perf_counter() - self._start) * 1000))
+        return '\n'.join(lines)
+
+
+# 预编译所有模板，第一个请求不用再付出编译的开销
+def precompile_templates(env):
+    for name in env.list_templates(filter_func=lambda n: n.endswith('.html')):
+        env.get_template(name)
+
+
+async def init_app(loop, timer=None):
+    timer = timer or StartupTimer()
+    check_worker_id()
+    init_access_log(configs.get('access_log', {}))
+    app = web.Application(loop=loop, middlewares=[metrics.metrics_factory, logger_factory, admission_factory,
+                                                  auth_factory, response_factory])
+    # /api/batch的子请求经过的middleware：登录用户取自外层请求，不再记录访问日志
+    app['__sub_request_middlewares__'] = [admission_factory, response_factory]
+
+    async def init_db():
+        with timer.phase('create pool'):
+            await orm.create_pool(loop=loop, **configs.db)
+
+    async def init_templates():
+        with timer.phase('init jinja2'):
+            init_jinja2(app, filters=dict(datetime=datetime_filter, markdown=markdown, text2html=text2html),
+                        extensions=[FragmentCacheExtension])
+        # 模板编译是CPU操作，放到线程中执行，与建立数据库连接并行
+        with timer.phase('precompile templates'):
+            await loop.run_in_executor(None, precompile_templates, app['__templating__'])
+
+    await asyncio.gather(init_db(), init_templates())
+    # 可选的子系统只在启用时导入；搜索要在任务队列之前导入，spool中的索引任务才能找到处理函数
+    if configs.get('shared_cache', {}).get('enabled', False):
+        with timer.phase('init shared cache'):
+            from webapp.www import sharedcache
+            sharedcache.init(app, loop, configs.shared_cache)
+    if configs.get('search', {}).get('enabled', True):
+        with timer.phase('init search'):
+            from webapp.www import search
+            search.init(app)
+    with timer.phase('init jobs'):
+        jobs.init(app)
+    if configs.get('frontpage', {}).get('enabled', True):
+        with timer.phase('init front page'):
+            from webapp.www import frontpage
+            frontpage.init(app)
+    syndication.init(app)
+    with timer.phase('add routes'):
+        add_routes(app, 'webapp.www.handlers')
+        add_static(app)
+    return app
+
+
 async def init(loop):
-    await orm.create_pool(loop=loop, **configs.db)
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
-    add_routes(app, 'handlers')
-    add_static(app)
+    app = await init_app(loop)
+    if configs.get('diagnostics', {}).get('enabled', True):
+        from webapp.www import diagnostics
+        diagnostics.init(app, loop)
     server = await loop.create_server(app.make_handler(), configs.server.host, configs.server.port)
     logging.info('server started at http://%s:%s' % (configs.server.host, configs.server.port))
     return server
 
 
+# 只执行启动流程并打印各阶段耗时，不监听端口；之后按正常关闭的流程停止各子系统的后台任务
+async def check_startup(loop):
+    timer = StartupTimer()
+    app = await init_app(loop, timer)
+    print(timer.report())
+    app.freeze()
+    await app.shutdown()
+    await app.cleanup()
+    await orm.close_pool()
+
+
 def run_server():
     loop = asyncio.get_event_loop()
+    if '--check-startup' in sys.argv[1:]:
+        loop.run_until_complete(check_startup(loop))
+        return
     loop.run_until_complete(init(loop))
     loop.run_forever()
 
@@ -0,0 +1,82 @@
+"""
+进程内的LRU缓存，按条目数和估算的内存大小双重限制，支持每个条目单独的TTL
+"""
+
+import sys
+import time
+from collections import OrderedDict
+
+
+# 粗略估算对象占用的内存（字节），只用于控制缓存总量，不追求精确
+def estimate_size(obj):
+    if isinstance(obj, (str, bytes)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_size(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class LRUCache(object):
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # key -> (value, expires, size)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires, size = entry
+        if expires is not None and expires < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None, size=None):
+        if size is None:
+            size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        expires = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires, size)
+        self.bytes += size
+        while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+            old_key = next(iter(self._data))
+            self._remove(old_key)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(entries=len(self._data), bytes=self.bytes, max_entries=self.max_entries,
+                    max_bytes=self.max_bytes, hits=self.hits, misses=self.misses,
+                    hit_ratio=self.hits / total if total else 0.0,
+                    evictions=self.evictions, expirations=self.expirations)
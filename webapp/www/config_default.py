@@ -1,3 +1,5 @@
+import os
+
 # 开发环境的配置参数
 configs = {
     'db': {
@@ -5,7 +7,21 @@ configs = {
         'port': 3306,
         'user': 'root',
         'password': '123456',
-        'database': 'awesome'
+        'database': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        'warmup': 5,
+        'pool_recycle': 3600,
+        'ping_after': 60,
+        'query_timeout': 10,
+        'adapt_interval': 5,
+        'grow_wait': 0.005,
+        'idle_timeout': 300,
+        # orm.gather中一个请求最多同时执行的查询数
+        'fanout': 4,
+        # 分页时是否用窗口函数count(*) over()同时取总数（MySQL 8、MariaDB 10.2以上支持）；
+        # None表示创建连接池时按select version()检测，旧版本用SQL_CALC_FOUND_ROWS
+        'window_functions': None
     },
     'server': {
         'host': '192.168.31.131',
@@ -13,5 +29,112 @@ configs = {
     },
     'session': {
         'secret': 'Awesome'
+    },
+    # 口令哈希：algorithm为pbkdf2_sha256或scrypt；workers为专用线程数，max_pending为最多排队的计算数
+    'passwords': {
+        'algorithm': 'pbkdf2_sha256',
+        'iterations': 200000,
+        'workers': 2,
+        'max_pending': 32
+    },
+    # ID生成：worker为0~15的编号，写同一个数据库的每个进程必须不同（例如按启动顺序0、1、2...），否则会生成重复主键
+    # processes为写同一个数据库的进程数；processes大于1或启用了shared_cache时，不设置worker会拒绝启动；
+    # 单进程部署可以不设置，使用0
+    'ids': {
+        'worker': None,
+        'processes': 1
+    },
+    # 查询结果缓存：总条目数、估算内存上限，ttl可按表名覆盖Model的__cache_ttl__（0表示不缓存）
+    'cache': {
+        'enabled': True,
+        'max_entries': 10000,
+        'max_bytes': 64 * 1024 * 1024,
+        'ttl': {}
+    },
+    # 模板片段缓存（{% cache key, ttl %}）：条目数、估算内存上限，默认ttl(秒)
+    'fragments': {
+        'enabled': True,
+        'max_entries': 5000,
+        'max_bytes': 32 * 1024 * 1024,
+        'ttl': 300
+    },
+    # 多worker部署时的共享缓存：mmap文件、槽数与槽大小（总内存=slots*slot_size，整台机器共用），
+    # socket_dir下每个worker一个Unix socket，用于广播写入通知，让其它worker更新搜索索引和首页
+    'shared_cache': {
+        'enabled': False,
+        'path': '/dev/shm/awesome/cache',
+        'slots': 16384,
+        'slot_size': 4096,
+        'socket_dir': '/dev/shm/awesome/sockets'
+    },
+    # 由表版本号生成的ETag：不使用共享缓存时，max_age(秒)后ETag自动变化，以免看不到其它worker的写入
+    'etag': {
+        'max_age': 30
+    },
+    # /api/batch：每批最多的子请求数，同时执行的子请求数
+    'batch': {
+        'max_requests': 20,
+        'concurrency': 4
+    },
+    # 首页物化视图：内存中保存的最新blog数，首页和/api/blogs在这个范围内的页不查数据库
+    'frontpage': {
+        'enabled': True,
+        'size': 100
+    },
+    # 异步任务队列：同时执行的任务数、最多尝试次数、重试退避的基数(秒)、spool文件、
+    # 累计多少条完成记录后重写spool文件、关闭时等待任务完成的最长时间(秒)
+    'jobs': {
+        'enabled': True,
+        'concurrency': 4,
+        'max_attempts': 5,
+        'backoff': 1.0,
+        'spool': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'jobs.spool'),
+        'compact_after': 1000,
+        'drain_timeout': 10
+    },
+    # Atom/RSS订阅：条目数、标题、站点地址（如'https://example.com'，为None时用server的host和port；
+    # 不取请求的Host，以免伪造的Host写进对所有人缓存的文档）、Cache-Control的max-age(秒)
+    'feed': {
+        'size': 20,
+        'title': 'Awesome Python Webapp',
+        'url': None,
+        'max_age': 300
+    },
+    # 全文搜索：索引快照文件、快照间隔(秒)、建索引时每批读取的行数
+    'search': {
+        'enabled': True,
+        'snapshot': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'search.idx'),
+        'snapshot_interval': 300,
+        'batch': 500
+    },
+    # 结构化访问日志，每个请求一行JSON，可交给webapp/test/replay.py回放；path为None时不记录
+    'access_log': {
+        'path': None
+    },
+    # 事件循环诊断：探针间隔、判定为阻塞的时长(秒)，/manage/debug/profile的最长采样时间和采样间隔
+    'diagnostics': {
+        'enabled': True,
+        'lag_interval': 0.1,
+        'slow_threshold': 0.25,
+        'max_profile_seconds': 60,
+        'sample_interval': 0.005
+    },
+    # 请求截止时间(秒)，可用@get/@post的timeout参数按路由覆盖；disconnect_poll为检查客户端断开的间隔
+    'deadline': {
+        'default': 10,
+        'disconnect_poll': 0.5
+    },
+    # 准入控制：全局并发上限、等待队列长度、排队超时(秒)，routes中可按"方法 路由模板"单独限制，
+    # 同一路由的GET和POST各用各的闸门；只写路由模板时对每个方法分别生效
+    'admission': {
+        'enabled': True,
+        'limit': 20,
+        'queue': 100,
+        'timeout': 2.0,
+        'retry_after': 1,
+        'routes': {
+            'POST /api/blogs/{id}/comments': {'limit': 5, 'queue': 20},
+            'POST /api/authenticate': {'limit': 5, 'queue': 20},
+        }
     }
 }
@@ -1,17 +1,31 @@
 import functools
 import asyncio
 import inspect
+import json
 import logging
 import os
 from urllib import parse
 from aiohttp import web
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+from webapp.www import deadline
 from webapp.www.apis import APIError
+from webapp.www.config import configs
+from webapp.www.orm import QueryTimeout
 
 
 # 参考 http://blog.csdn.net/jyk920902/article/details/78262416
 
+# 预先计算的路由表：模块名 -> [URL处理函数]，在装饰时登记，启动时无需再遍历dir(mod)
+_route_table = {}
+
+
 # URL处理函数的装饰器，存储请求方式、URL
-def request(path, *, method):
+# priority：准入控制的优先级类别（'write'、'read'...），不指定时按请求方式决定
+# timeout：请求的截止时间(秒)，不指定时使用configs.deadline.default，0表示不设截止时间
+# etag：响应内容所依赖的表，由这些表的版本号生成ETag，未修改时不执行URL处理函数，直接返回304
+# cache_control：响应的Cache-Control头
+def request(path, *, method, priority=None, timeout=None, etag=None, cache_control=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
@@ -19,6 +33,11 @@ def request(path, *, method):
 
         wrapper.__method__ = method
         wrapper.__route__ = path
+        wrapper.__priority__ = priority
+        wrapper.__timeout__ = timeout
+        wrapper.__etag__ = etag
+        wrapper.__cache_control__ = cache_control
+        _route_table.setdefault(func.__module__, []).append(wrapper)
         return wrapper
 
     return decorator
@@ -39,11 +58,17 @@ POSITIONAL_OR_KEYWORD    位置或必选参数
 """
 
 
+# 缓存函数签名，同一个URL处理函数只分析一次，不再每个判断函数各调用一次inspect.signature
+@functools.lru_cache(maxsize=None)
+def get_signature(fn):
+    return inspect.signature(fn)
+
+
 # 获取函数的无默认值的命名关键字参数名
 def get_required_kw_args(fn):
     args = []
     # 获取函数fn的参数列表
-    params = inspect.signature(fn).parameters
+    params = get_signature(fn).parameters
     for name, param in params.items():
         # 函数fn有命名关键字参数，并且默认值为空，则记录参数名
         if param.kind == inspect.Parameter.KEYWORD_ONLY and param.default == inspect.Parameter.empty:
@@ -54,7 +79,7 @@ def get_required_kw_args(fn):
 # 获取函数的命名关键字参数名
 def get_named_kw_args(fn):
     args = []
-    params = inspect.signature(fn).parameters
+    params = get_signature(fn).parameters
     for name, param in params.items():
         if param.kind == inspect.Parameter.KEYWORD_ONLY:
             args.append(name)
@@ -63,7 +88,7 @@ def get_named_kw_args(fn):
 
 # 函数是否有命名关键字参数
 def has_named_kw_args(fn):
-    params = inspect.signature(fn).parameters
+    params = get_signature(fn).parameters
     for name, param in params.items():
         if param.kind == inspect.Parameter.KEYWORD_ONLY:
             return True
@@ -71,7 +96,7 @@ def has_named_kw_args(fn):
 
 # 函数是否有关键字参数
 def has_var_kw_arg(fn):
-    params = inspect.signature(fn).parameters
+    params = get_signature(fn).parameters
     for name, param in params.items():
         if param.kind == inspect.Parameter.VAR_KEYWORD:
             return True
@@ -79,7 +104,7 @@ def has_var_kw_arg(fn):
 
 # 函数是否有request参数
 def has_request_arg(fn):
-    sig = inspect.signature(fn)
+    sig = get_signature(fn)
     params = sig.parameters
     found = False
     for name, param in params.items():
@@ -108,6 +133,10 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        # timeout=0表示不设截止时间，None才使用默认值
+        self._timeout = getattr(fn, '__timeout__', None)
+        if self._timeout is None:
+            self._timeout = configs.get('deadline', {}).get('default')
 
     async def __call__(self, request):
         kw = None
@@ -178,12 +207,109 @@ class RequestHandler(object):
                     return web.HTTPBadRequest('Missing argument: %s' % name)
         # 到这里完成了request中参数的检验
         logging.info('call with args: %s' % str(kw))
+        token = deadline.set_deadline(self._timeout)
         try:
             # 执行URL处理函数
-            r = await self._func(**kw)
+            r = await self._call(request, kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
+        except (deadline.DeadlineExceeded, QueryTimeout) as e:
+            logging.warning('%s %s: %s' % (request.method, request.path, e))
+            return web.HTTPGatewayTimeout()
+        finally:
+            deadline.reset(token)
+
+    # 在截止时间内执行URL处理函数；超时，或客户端已经断开时取消，不再占用数据库连接
+    async def _call(self, request, kw):
+        if not self._timeout:
+            return await self._func(**kw)
+        poll = configs.get('deadline', {}).get('disconnect_poll', 0.5)
+        task = asyncio.ensure_future(self._func(**kw))
+        try:
+            while True:
+                left = deadline.remaining()
+                done, _ = await asyncio.wait({task}, timeout=max(0, min(poll, left)))
+                if done:
+                    return task.result()
+                if deadline.remaining() <= 0:
+                    task.cancel()
+                    raise deadline.DeadlineExceeded('request deadline exceeded')
+                transport = request.transport
+                if transport is None or transport.is_closing():
+                    logging.info('client disconnected, cancel %s %s' % (request.method, request.path))
+                    task.cancel()
+                    raise asyncio.CancelledError()
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+
+# 取得request匹配到的路由模板，如/blog/{id}，按路由统计、限流时使用，避免原始路径让维度爆炸
+def route_of(request):
+    route = request.match_info.route
+    resource = getattr(route, 'resource', None)
+    if resource is None:
+        return '<unmatched>'
+    canonical = getattr(resource, 'canonical', None)
+    if canonical is not None:
+        return canonical
+    info = resource.get_info()
+    return info.get('formatter') or info.get('path') or info.get('prefix') or '<unknown>'
+
+
+# 取得request对应的URL处理函数上由装饰器设置的属性
+def route_option(request, name, default=None):
+    handler = getattr(request.match_info.handler, 'request_handler', None)
+    fn = getattr(handler, '_func', None)
+    return getattr(fn, name, default)
+
+
+# /api/batch的子请求：方法、路径、查询参数、路由匹配结果、If-None-Match是自己的，其余（连接、cookie、app）取自外层请求
+# 外层请求的body已经读过，不能再用request.clone()
+class SubRequest(object):
+    def __init__(self, request, method, path, etag=None):
+        self._request = request
+        self.method = method
+        self.rel_url = URL(path)
+        self.path = self.rel_url.path
+        self.path_qs = path
+        self.query_string = self.rel_url.query_string
+        self.query = self.rel_url.query
+        self.match_info = None
+        headers = CIMultiDict(request.headers)
+        headers.popall('If-None-Match', None)
+        if etag:
+            headers['If-None-Match'] = etag
+        self.headers = CIMultiDictProxy(headers)
+        # 共用外层请求的登录用户；外层请求已经占用了全局准入闸门
+        self.__user__ = request.__user__
+        self.__sub_request__ = True
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+
+# 执行path对应的URL处理函数，经过app['__sub_request_middlewares__']中的middleware（准入控制、ETag/304、构造响应），
+# 返回(状态码, 返回值, ETag)；JSON响应的返回值是解码后的对象，304时为None
+async def call_sub_request(request, method, path, etag=None):
+    sub = SubRequest(request, method, path, etag)
+    match_info = await request.app.router.resolve(sub)
+    if match_info.http_exception is not None:
+        return match_info.http_exception.status, None, None
+    sub.match_info = match_info
+    handler = match_info.handler
+    for factory in reversed(request.app.get('__sub_request_middlewares__', ())):
+        handler = await factory(request.app, handler)
+    try:
+        resp = await handler(sub)
+    except web.HTTPException as e:
+        return e.status, None, None
+    body = None
+    if isinstance(resp, web.Response) and resp.body is not None and resp.status != 304:
+        body = json.loads(resp.body.decode(resp.charset or 'utf-8')) if resp.content_type == 'application/json' \
+            else resp.text
+    return resp.status, body, resp.headers.get('ETag')
 
 
 # 注册静态资源如css、js，这里只要是添加前端框架的资源（放在static目录下）
@@ -193,6 +319,18 @@ def add_static(app):
     logging.info('add static %s => %s' % ('/static/', path))
 
 
+# 把普通函数包装成协程函数；@get/@post装饰后的函数返回的可能是协程，也可能是普通的值
+def to_coroutine(fn):
+    @functools.wraps(fn)
+    async def coro(*args, **kw):
+        r = fn(*args, **kw)
+        if inspect.isawaitable(r):
+            r = await r
+        return r
+
+    return coro
+
+
 # 注册单个URL处理函数
 def add_route(app, fn):
     # URL处理函数fn的请求方式
@@ -201,14 +339,23 @@ def add_route(app, fn):
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    # URL处理函数不是协程 并且 不是生成器
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        # 将URL处理函数转成协程
-        fn = asyncio.coroutine(fn)
+    # URL处理函数不是协程函数时，包装成协程函数（asyncio.coroutine在Python 3.11中已删除）
+    if not asyncio.iscoroutinefunction(fn):
+        fn = to_coroutine(fn)
     logging.info(
-        'add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+        'add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(get_signature(fn).parameters.keys())))
     # 注册URL处理函数
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    app.router.add_route(method, path, route_handler(RequestHandler(app, fn)))
+
+
+# aiohttp只有协程函数的返回值可以是任意对象（由response_factory转换），其它可调用对象必须返回StreamResponse，
+# 所以RequestHandler实例包在async def中注册
+def route_handler(handler):
+    async def handle(request):
+        return await handler(request)
+
+    handle.request_handler = handler
+    return handle
 
 
 # 批量注册模块中的URL处理函数
@@ -224,6 +371,12 @@ def add_routes(app, module_name):
         name = module_name[n + 1:]
         # __import__(module_name[:n], globals(), locals(), [name]) ==> from module_name[:n] import name
         mod = getattr(__import__(module_name[:n], globals(), locals(), [name]), name)
+    # 优先使用装饰时登记的路由表
+    routes = _route_table.get(mod.__name__)
+    if routes:
+        for fn in routes:
+            add_route(app, fn)
+        return
     # 迭代mod模块中所有的类，实例及函数等对象, str形式
     for attr in dir(mod):
         if attr.startswith('_'):
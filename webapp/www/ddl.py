@@ -0,0 +1,135 @@
+"""
+由Model的__mappings__和__indexes__生成DDL，与线上数据库比对差异，并对运行时出现过的SQL做EXPLAIN检查
+
+用法：
+    python -m webapp.www.ddl schema     # 打印建表语句
+    python -m webapp.www.ddl diff       # 打印让数据库与Model一致所需的alter语句
+运行中的进程可以通过 /manage/explain 查看EXPLAIN检查结果
+"""
+
+import asyncio
+import re
+import sys
+
+from webapp.www import orm
+from webapp.www.config import configs
+from webapp.www.models import User, Blog, Comment
+
+MODELS = [User, Blog, Comment]
+
+
+# MySQL不允许text/blob列有字面量默认值，这类列的默认值只在Model中生效
+def column_sql(name, field):
+    sql = '`%s` %s not null' % (name, field.column_type)
+    if field.default is not None and not callable(field.default) and not field.primary_key \
+            and not re.search(r'text|blob', field.column_type):
+        sql += ' default %s' % (int(field.default) if isinstance(field.default, bool) else repr(field.default))
+    return sql
+
+
+def index_sql(index):
+    return '%skey `%s` (%s)' % ('unique ' if index.unique else '', index.name,
+                                ', '.join('`%s`' % c for c in index.columns))
+
+
+def create_table_sql(model):
+    lines = [column_sql(name, field) for name, field in model.__mappings__.items()]
+    lines.extend(index_sql(index) for index in model.__indexes__)
+    lines.append('primary key (`%s`)' % model.__primary_key__)
+    return 'create table `%s` (\n    %s\n) engine=innodb default charset=utf8;' % (
+        model.__table__, ',\n    '.join(lines))
+
+
+def schema_sql(models=MODELS):
+    return '\n\n'.join(create_table_sql(model) for model in models)
+
+
+# MySQL报告的类型与声明的写法不同：bool -> tinyint(1)、real -> double、bigint -> bigint(20)
+def _normalize_type(t):
+    t = t.lower()
+    t = {'bool': 'tinyint', 'boolean': 'tinyint', 'real': 'double'}.get(t, t)
+    return re.sub(r'^(tinyint|smallint|int|bigint)\(\d+\)', r'\1', t)
+
+
+# 比对information_schema，返回需要执行的alter语句
+async def diff(models=MODELS):
+    db = configs.db.database
+    statements = []
+    for model in models:
+        table = model.__table__
+        columns = await orm.select('select column_name as name, column_type as type from information_schema.columns '
+                                   'where table_schema=? and table_name=?', [db, table])
+        if not columns:
+            statements.append(create_table_sql(model))
+            continue
+        existing = {r['name']: r['type'] for r in columns}
+        for name, field in model.__mappings__.items():
+            if name not in existing:
+                statements.append('alter table `%s` add column %s;' % (table, column_sql(name, field)))
+            elif _normalize_type(existing[name]) != _normalize_type(field.column_type):
+                statements.append('alter table `%s` modify column %s;' % (table, column_sql(name, field)))
+        rows = await orm.select('select index_name as name, column_name as col, non_unique as non_unique '
+                                'from information_schema.statistics where table_schema=? and table_name=? '
+                                'order by index_name, seq_in_index', [db, table])
+        indexes = {}
+        for r in rows:
+            indexes.setdefault(r['name'], (not r['non_unique'], []))[1].append(r['col'])
+        declared = {index.name: index for index in model.__indexes__}
+        for name, index in declared.items():
+            actual = indexes.get(name)
+            if actual is None:
+                statements.append('alter table `%s` add %s;' % (table, index_sql(index)))
+            elif actual[1] != list(index.columns) or actual[0] != index.unique:
+                statements.append('alter table `%s` drop index `%s`, add %s;' % (table, name, index_sql(index)))
+        for name in indexes:
+            if name != 'PRIMARY' and name not in declared:
+                statements.append('alter table `%s` drop index `%s`;' % (table, name))
+    return statements
+
+
+# 对运行时捕获的每种SQL执行EXPLAIN，标出全表扫描和filesort
+async def explain_queries(shapes=None):
+    if shapes is None:
+        shapes = orm.query_shapes()
+    report = []
+    for sql, args in shapes.items():
+        if not sql.lower().startswith(('select', 'update', 'delete')):
+            continue
+        try:
+            plan = await orm.select('explain ' + sql, args)
+        except Exception as e:
+            report.append(dict(sql=sql, error=str(e)))
+            continue
+        problems = []
+        for row in plan:
+            extra = row.get('Extra') or ''
+            if row.get('type') == 'ALL':
+                problems.append('full scan on %s (rows=%s)' % (row.get('table'), row.get('rows')))
+            if 'filesort' in extra:
+                problems.append('filesort on %s' % row.get('table'))
+            if 'temporary' in extra:
+                problems.append('temporary table on %s' % row.get('table'))
+        report.append(dict(sql=sql, problems=problems, plan=plan))
+    # 有问题的排在前面
+    report.sort(key=lambda r: not (r.get('problems') or r.get('error')))
+    return report
+
+
+async def main(loop, command):
+    if command == 'schema':
+        print(schema_sql())
+        return
+    await orm.create_pool(loop=loop, **configs.db)
+    try:
+        if command == 'diff':
+            for sql in await diff():
+                print(sql)
+        else:
+            raise ValueError('unknown command: %s' % command)
+    finally:
+        await orm.close_pool()
+
+
+if '__main__' == __name__:
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, sys.argv[1] if len(sys.argv) > 1 else 'schema'))
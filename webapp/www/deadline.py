@@ -0,0 +1,44 @@
+"""
+请求的截止时间，存在contextvar中，从RequestHandler一直传到orm的每条SQL
+"""
+
+import contextvars
+import time
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# 设置当前上下文的截止时间（从现在起seconds秒），返回的token用于reset
+# 已有更早的截止时间（例如/api/batch的子请求继承外层请求的）时保留更早的那个；seconds为0时不设置新的截止时间
+def set_deadline(seconds):
+    current = _deadline.get()
+    if not seconds:
+        return _deadline.set(current)
+    deadline = time.monotonic() + seconds
+    if current is not None and current < deadline:
+        deadline = current
+    return _deadline.set(deadline)
+
+
+def reset(token):
+    _deadline.reset(token)
+
+
+# 剩余时间(秒)，没有设置截止时间时返回None
+def remaining():
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+# 已经超时就抛出DeadlineExceeded，否则返回剩余时间
+def check():
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('request deadline exceeded')
+    return left
@@ -0,0 +1,201 @@
+"""
+事件循环的诊断工具
+
+- 循环延迟探针：每隔interval秒醒来一次，实际醒来时间比预期晚多少就是循环被占用的时间，记入直方图
+- 阻塞检测：后台线程发现探针超过slow_threshold秒没有醒来时，抓取主线程的调用栈，找出正在执行的路由
+- 采样分析：/manage/debug/profile按固定间隔采样主线程调用栈，或对比前后两次tracemalloc快照，
+  输出flamegraph.pl、speedscope可直接读取的collapsed stack格式
+"""
+
+import asyncio
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter as _Counter, deque
+
+from webapp.www import coroweb, metrics
+from webapp.www.config import configs
+
+LOOP_LAG = metrics.registry.register(metrics.Histogram('event_loop_lag_seconds',
+                                                       'How late the event loop probe woke up.'))
+LOOP_BLOCKED = metrics.registry.register(metrics.Counter('event_loop_blocked_total',
+                                                         'Times the event loop was blocked, by route.', ('route',)))
+
+_main_thread_id = None
+_heartbeat = None
+_probe = None
+_watchdog = None
+_stopping = threading.Event()
+_profiling = False
+# 最近几次阻塞的记录
+recent_blocks = deque(maxlen=20)
+
+
+def _config():
+    return configs.get('diagnostics', {})
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+# 从最外层到最内层的调用栈，拼成collapsed stack的一行
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# URL处理函数的code对象 -> 'GET /blog/{id}'
+_handler_codes = None
+
+
+def _handler_code_map():
+    global _handler_codes
+    if _handler_codes is None:
+        _handler_codes = {}
+        for fns in coroweb._route_table.values():
+            for fn in fns:
+                _handler_codes[inspect.unwrap(fn).__code__] = '%s %s' % (fn.__method__, fn.__route__)
+    return _handler_codes
+
+
+# 由调用栈找出正在处理的路由：栈中的URL处理函数，或middleware、RequestHandler中的request局部变量
+def attribute(frame):
+    codes = _handler_code_map()
+    while frame is not None:
+        route = codes.get(frame.f_code)
+        if route is not None:
+            return route
+        request = frame.f_locals.get('request')
+        if request is not None and hasattr(request, 'match_info'):
+            try:
+                return '%s %s' % (request.method, coroweb.route_of(request))
+            except Exception:
+                pass
+        frame = frame.f_back
+    return '<no request>'
+
+
+# 在事件循环中运行的探针
+async def _probe_loop(interval):
+    global _heartbeat
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + interval
+        _heartbeat = time.monotonic()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(value=max(0.0, loop.time() - expected))
+
+
+# 后台线程：探针超时未醒来，说明有回调占住了事件循环
+def _watch(threshold, check_every):
+    reported = None
+    while not _stopping.wait(check_every):
+        beat = _heartbeat
+        if beat is None:
+            continue
+        blocked = time.monotonic() - beat
+        if blocked < threshold:
+            continue
+        if reported == beat:
+            # 同一次阻塞只报告一次
+            continue
+        reported = beat
+        frame = sys._current_frames().get(_main_thread_id)
+        if frame is None:
+            continue
+        route = attribute(frame)
+        stack = collapse(frame)
+        del frame
+        LOOP_BLOCKED.inc(route)
+        recent_blocks.append(dict(time=time.time(), blocked=blocked, route=route, stack=stack))
+        logging.warning('event loop blocked for %.3fs in %s: %s' % (blocked, route, stack))
+
+
+def init(app, loop):
+    global _main_thread_id, _probe, _watchdog
+    conf = _config()
+    if not conf.get('enabled', True):
+        return
+    _main_thread_id = threading.get_ident()
+    interval = conf.get('lag_interval', 0.1)
+    threshold = conf.get('slow_threshold', 0.25)
+    _probe = asyncio.ensure_future(_probe_loop(interval))
+    _stopping.clear()
+    _watchdog = threading.Thread(target=_watch, args=(threshold + interval, threshold / 2),
+                                 name='loop-watchdog', daemon=True)
+    _watchdog.start()
+
+    async def on_shutdown(app):
+        _stopping.set()
+        _probe.cancel()
+
+    app.on_shutdown.append(on_shutdown)
+
+
+# 在线程中按固定间隔采样主线程的调用栈
+def sample_stacks(seconds, interval):
+    stacks = _Counter()
+    thread_id = _main_thread_id or threading.main_thread().ident
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[collapse(frame)] += 1
+            del frame
+        time.sleep(interval)
+    return stacks
+
+
+# 对比前后两次快照，每个分配调用栈的新增字节数
+async def sample_allocations(seconds, frames=16):
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    stacks = _Counter()
+    # traceback中最外层的帧在前，与collapsed stack的顺序一致
+    for stat in after.filter_traces(filters).compare_to(before.filter_traces(filters), 'traceback'):
+        if stat.size_diff <= 0:
+            continue
+        names = ['%s:%s' % (os.path.basename(f.filename), f.lineno) for f in stat.traceback]
+        stacks[';'.join(names)] += stat.size_diff
+    return stacks
+
+
+def format_collapsed(stacks):
+    return ''.join('%s %s\n' % (stack, count) for stack, count in stacks.most_common())
+
+
+# 采样seconds秒，kind为'cpu'（调用栈采样）或'alloc'（内存分配），同一时间只允许一个
+async def profile(seconds, kind='cpu'):
+    global _profiling
+    if _profiling:
+        raise RuntimeError('another profile is running')
+    seconds = min(max(float(seconds), 0.1), _config().get('max_profile_seconds', 60))
+    _profiling = True
+    try:
+        if kind == 'alloc':
+            stacks = await sample_allocations(seconds)
+        else:
+            loop = asyncio.get_event_loop()
+            stacks = await loop.run_in_executor(None, sample_stacks, seconds,
+                                                _config().get('sample_interval', 0.005))
+    finally:
+        _profiling = False
+    return format_collapsed(stacks)
@@ -0,0 +1,63 @@
+"""
+模板片段缓存：与查看者无关的部分渲染一次，之后直接输出缓存的HTML
+
+    {% cache ('blog', blog.id, blog.version), 600 %}
+        {{ blog.content|markdown|safe }}
+    {% endcache %}
+
+键可以是任意可repr的值，通常带上对象的版本号或table_version('comments')，
+ORM写入后版本号变化，旧片段不会再被命中，由LRU自然淘汰。ttl省略时使用configs.fragments.ttl。
+"""
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from webapp.www import orm
+from webapp.www.cache import LRUCache
+from webapp.www.config import configs
+
+
+def _config():
+    return configs.get('fragments', {})
+
+
+_fragments = LRUCache(max_entries=_config().get('max_entries', 5000),
+                      max_bytes=_config().get('max_bytes', 32 * 1024 * 1024))
+
+
+def stats():
+    return _fragments.stats()
+
+
+def clear():
+    _fragments.clear()
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.globals.setdefault('table_version', orm.table_version)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        # 模板名也作为键的一部分，不同模板里相同的键互不影响
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, template, key, ttl, caller):
+        if not _config().get('enabled', True):
+            return caller()
+        cache_key = '%s:%r' % (template, key)
+        html = _fragments.get(cache_key)
+        if html is None:
+            html = str(caller())
+            _fragments.set(cache_key, html, ttl or _config().get('ttl', 300))
+        return Markup(html)
@@ -0,0 +1,139 @@
+"""
+首页的物化视图：内存中按created_at倒序保存最新的N篇blog摘要（不含content）和blog总数
+
+启动时从数据库加载一次，之后由orm的变更监听随创建、编辑、删除增量更新，首页和/api/blogs的前几页不访问数据库。
+加载时记下blogs表的版本号，版本号与当前不一致（例如另一个worker写入了，见sharedcache）时视为过期，
+回退到数据库查询并在后台重新加载。
+"""
+
+import asyncio
+import logging
+
+from webapp.www import orm
+from webapp.www.config import configs
+from webapp.www.models import Blog
+
+SUMMARY_FIELDS = [f for f in Blog.__fields__ + [Blog.__primary_key__] if f != 'content']
+
+_blogs = []
+_total = 0
+# 加载或最后一次增量更新时blogs表的版本号，None表示尚未加载
+_version = None
+_loading = None
+
+
+def _config():
+    return configs.get('frontpage', {})
+
+
+def _size():
+    return _config().get('size', 100)
+
+
+def _sort_key(blog):
+    return blog.created_at, int(blog.id)
+
+
+# 去掉content，并把字段值统一成从数据库读出时的形式
+def summarize(blog):
+    return Blog.from_row({k: blog.get_db_value(k) for k in SUMMARY_FIELDS if k in blog})
+
+
+async def load():
+    global _blogs, _total, _version
+    version = orm.table_version(Blog.__table__)
+    blogs, total = await Blog.find_page(1, _size(), order_by='created_at desc, id desc', total=None)
+    _blogs = [summarize(b) for b in blogs]
+    _total = total
+    # 加载期间有写入时，版本号对不上，下次访问会再加载一次
+    _version = version
+    logging.info('front page loaded: %s of %s blogs' % (len(_blogs), _total))
+
+
+def reload():
+    global _loading
+    if _loading is None or _loading.done():
+        _loading = asyncio.ensure_future(load())
+    return _loading
+
+
+def _fresh():
+    return _version is not None and _version == orm.table_version(Blog.__table__)
+
+
+# 第page_index页，返回(blogs, total)；不在窗口内或已过期时返回None，由调用方查询数据库
+def page(page_index, page_size):
+    if not _config().get('enabled', True):
+        return None
+    if not _fresh():
+        if _version is not None:
+            reload()
+        return None
+    offset = page_size * (page_index - 1)
+    if offset + page_size > len(_blogs) and len(_blogs) < _total:
+        return None
+    return _blogs[offset:offset + page_size], _total
+
+
+def on_change(event, model):
+    global _total, _version
+    if not isinstance(model, Blog) or _version is None:
+        return
+    if event == 'increment':
+        # 计数器不改变blogs表的版本号，直接合并到窗口内的摘要中
+        summary = next((b for b in _blogs if b.id == str(model.id)), None)
+        if summary is not None:
+            dict.update(summary, summarize(model))
+        return
+    # 增量更新前已经过期，说明漏掉了别处的写入，只能重新加载
+    if _version != orm.table_version(Blog.__table__) - 1:
+        reload()
+        return
+    index = next((i for i, b in enumerate(_blogs) if b.id == str(model.id)), None)
+    if event == 'save':
+        _blogs.append(summarize(model))
+        _total += 1
+    elif event == 'update':
+        if index is None:
+            _version = orm.table_version(Blog.__table__)
+            return
+        # Model.update()是写数据库的方法，这里用dict的update
+        dict.update(_blogs[index], summarize(model))
+    elif event == 'remove':
+        _total -= 1
+        if index is not None:
+            del _blogs[index]
+            if len(_blogs) < min(_size(), _total):
+                # 窗口不满了，从数据库补齐
+                reload()
+                return
+    _blogs.sort(key=_sort_key, reverse=True)
+    del _blogs[_size():]
+    _version = orm.table_version(Blog.__table__)
+
+
+# 其它worker写了blogs表（包括计数器）：本进程没有变更的内容，在后台重新加载；
+# 正在加载时可能已经错过这次写入，等它结束后再加载一次
+def on_remote_change(event, name):
+    if name.partition(':')[0] != Blog.__table__ or _version is None:
+        return
+    if _loading is not None and not _loading.done():
+        _loading.add_done_callback(lambda f: f.cancelled() or reload())
+    else:
+        reload()
+
+
+def init(app):
+    if not _config().get('enabled', True):
+        return
+    orm.add_listener(on_change)
+    orm.subscribe_remote(on_remote_change)
+    reload()
+
+    # 关闭时取消还没完成的加载
+    async def on_shutdown(app):
+        if _loading is not None and not _loading.done():
+            _loading.cancel()
+            await asyncio.gather(_loading, return_exceptions=True)
+
+    app.on_shutdown.append(on_shutdown)
@@ -1,33 +1,37 @@
+import asyncio
 import hashlib
 import logging
 import re
 import time
 import json
+import math
 
-import markdown2 as markdown2
 from aiohttp import web
 
+# 搜索、首页视图、诊断等可选的子系统在用到时才导入，未启用时不增加启动时间
+from webapp.www import admission, fragments, metrics, orm, passwords, syndication
 from webapp.www.apis import APIValueError, APIError, APIPermissionError, Page, APIResourceNotFoundError
 from webapp.www.config import configs
-from webapp.www.coroweb import get, post
+from webapp.www.coroweb import get, post, call_sub_request
 from webapp.www.models import User, Blog, next_id, Comment
+from webapp.www.orm import StaleObjectError
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+PAGE_SIZE = 10
+# blog页面直接渲染的评论数，其余的通过/api/blogs/{id}/comments?cursor=分页加载
+COMMENT_PAGE_SIZE = 20
 
 
 @get('/')
-async def index():
-    summary = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
-    blogs = [
-        Blog(id='1', name='Test Blog', summary=summary, created_at=time.time() - 120),
-        Blog(id='2', name='Something New', summary=summary, created_at=time.time() - 3600),
-        Blog(id='3', name='Learn Swift', summary=summary, created_at=time.time() - 7200)
-    ]
+async def index(*, page='1'):
+    page_index = get_page_index(page)
+    blogs, num = await blog_page(page_index)
     return {
         '__template__': 'blogs.html',
+        'page': Page(num, page_index, PAGE_SIZE),
         'blogs': blogs
     }
 
@@ -89,15 +93,18 @@ def manage_edit_blog(*, id):
 # 根据id查询blog内容
 @get('/blog/{id}')
 async def get_blog(id):
-    blog = await Blog.find(id)
-    comments = await Comment.find_all('blog_id=?', [id], order_by='created_at desc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    blog, (comments, next_cursor), comment_count = await orm.gather(
+        Blog.find(id), comment_page(id), Blog.find_counter(id, 'comment_count'))
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    # 缓存的blog行中评论数可能是旧的，用计数器的当前值
+    blog.comment_count = comment_count or 0
+    # markdown在模板的片段缓存中生成，命中缓存时不再转换；评论只渲染第一页，总数取blog.comment_count
     return {
         '__template__': 'blog.html',
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'next_cursor': next_cursor
     }
 
 
@@ -133,15 +140,70 @@ def manage_comments(*, page='1'):
     }
 
 
+# markdown2导入较慢，推迟到第一次渲染时再导入，加快启动
+_markdown = None
+
+
+def markdown(text):
+    global _markdown
+    if _markdown is None:
+        import markdown2
+        _markdown = markdown2.markdown
+    return _markdown(text)
+
+
 def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'),
                 filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
 
-# 检查是否登录
+# 评论分页的游标：上一页最后一条评论的created_at和id
+def comment_cursor(comment):
+    return '%r_%s' % (comment.created_at, comment.id)
+
+
+def parse_comment_cursor(cursor):
+    try:
+        created_at, id = cursor.split('_', 1)
+        created_at, id = float(created_at), int(id)
+    except ValueError:
+        raise APIValueError('cursor', 'Invalid cursor.')
+    # float()也接受nan、inf，不能带进SQL
+    if not math.isfinite(created_at):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return created_at, id
+
+
+# 按(created_at, id)倒序取blog的一页评论，返回(comments, next_cursor)，没有更多时next_cursor为None
+# 用游标而不是offset，翻到后面的页也只扫描一页的行
+async def comment_page(blog_id, cursor=None):
+    try:
+        blog_id = int(blog_id)
+    except ValueError:
+        return [], None
+    where = '`blog_id`=?'
+    args = [blog_id]
+    if cursor:
+        created_at, id = parse_comment_cursor(cursor)
+        where += ' and (`created_at`<? or (`created_at`=? and `id`<?))'
+        args.extend([created_at, created_at, id])
+    comments = await Comment.find_all(where, args, order_by='`created_at` desc, `id` desc',
+                                      limit=COMMENT_PAGE_SIZE + 1)
+    next_cursor = None
+    if len(comments) > COMMENT_PAGE_SIZE:
+        del comments[COMMENT_PAGE_SIZE:]
+        next_cursor = comment_cursor(comments[-1])
+    for c in comments:
+        # 加字段之前发表的评论没有html_content，显示时再转换
+        if not c.html_content:
+            c.html_content = text2html(c.content)
+    return comments, next_cursor
+
+
+# 检查是否为管理员
 def check_admin(request):
-    if not request.__user__:
+    if request.__user__ is None or not request.__user__.admin:
         raise APIPermissionError()
 
 
@@ -202,20 +264,33 @@ def get_page_index(page_str):
     return p
 
 
+# 客户端翻页时传回上一次拿到的总数，就不用再计算总数
+def get_total(total_str):
+    if total_str is None:
+        return None
+    try:
+        total = int(total_str)
+    except ValueError:
+        return None
+    return total if total >= 0 else None
+
+
 # 发表评论的api
-@post('/api/blogs/{id}/comments')
+@post('/api/blogs/{id}/comments', priority='write')
 async def api_create_comment(id, request, *, content):
     user = request.__user__
     if user is None:
         raise APIPermissionError('Please signin first.')
     if not content or not content.strip():
         raise APIValueError('content')
-    blog = await Blog.find(id)
+    blog = await Blog.find(id, cache=False)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
+    content = content.strip()
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image,
-                      content=content.strip())
+                      content=content, html_content=text2html(content))
     await comment.save()
+    await Blog.increment(blog.id, 'comment_count')
     return comment
 
 
@@ -223,41 +298,47 @@ async def api_create_comment(id, request, *, content):
 @post('/api/comments/{id}/delete')
 async def api_delete_comments(id, request):
     check_admin(request)
-    c = await Comment.find(id)
+    c = await Comment.find(id, cache=False)
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    await Blog.increment(c.blog_id, 'comment_count', -1)
     return dict(id=id)
 
 
+# blog的评论，按游标分页：第一页不带cursor，之后传入上一页返回的next_cursor
+@get('/api/blogs/{id}/comments', etag=['comments'], cache_control='private, no-cache')
+async def api_blog_comments(id, *, cursor=None):
+    comments, next_cursor = await comment_page(id, cursor)
+    return dict(comments=comments, next_cursor=next_cursor)
+
+
 # 分页查询评论列表的api
-@get('/api/comments')
-async def api_comments(*, page='1'):
+@get('/api/comments', etag=['comments'], cache_control='private, no-cache')
+async def api_comments(*, page='1', total=None):
     page_index = get_page_index(page)
-    num = await Comment.find_number('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
+    comments, num = await Comment.find_page(page_index, PAGE_SIZE, order_by='created_at desc', total=get_total(total))
+    p = Page(num, page_index, PAGE_SIZE)
+    if num == 0 or page_index > p.page_count:
         return dict(page=p, comments=())
-    comments = await Comment.find_all(order_by='created_at desc', limit=(p.offset, p.limit))
     return dict(page=p, comments=comments)
 
 
 # 分页查询用户信息的api
-@get('/api/users')
-async def api_get_users(*, page='1'):
+@get('/api/users', etag=['users'], cache_control='private, no-cache')
+async def api_get_users(*, page='1', total=None):
     page_index = get_page_index(page)
-    num = await User.find_number('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
+    users, num = await User.find_page(page_index, PAGE_SIZE, order_by='created_at desc', total=get_total(total))
+    p = Page(num, page_index, PAGE_SIZE)
+    if num == 0 or page_index > p.page_count:
         return dict(page=p, users=())
-    users = await User.find_all(order_by='created_at desc', limit=(p.offset, p.limit))
     for u in users:
         u.password = '******'
     return dict(page=p, users=users)
 
 
 # 注册api
-@post('/api/users')
+@post('/api/users', priority='write')
 async def api_register_user(*, email, name, password):
     if not name or not name.strip():
         raise APIValueError('name')
@@ -265,13 +346,12 @@ async def api_register_user(*, email, name, password):
         raise APIValueError('email')
     if not password or not _RE_SHA1.match(password):
         raise APIValueError('password')
-    users = await User.find_all('email=?', [email])
+    users = await User.find_all('email=?', [email], cache=False)
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
-    sha1_password = '%s:%s' % (uid, password)
     user = User(id=uid, name=name.strip(), email=email,
-                password=hashlib.sha1(sha1_password.encode('utf-8')).hexdigest(),
+                password=await passwords.hash_password(password),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
     await user.save()
     # make session cookie:
@@ -290,17 +370,18 @@ async def authenticate(*, email, password):
         raise APIValueError('email', 'Invalid email.')
     if not password:
         raise APIValueError('password', 'Invalid password.')
-    users = await User.find_all('email=?', [email])
+    users = await User.find_all('email=?', [email], cache=False)
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist.')
     user = users[0]
     # check password:
-    sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
-    sha1.update(b':')
-    sha1.update(password.encode('utf-8'))
-    if user.password != sha1.hexdigest():
+    ok, new_hash = await passwords.verify_password(user, password)
+    if not ok:
         raise APIValueError('password', 'Invalid password.')
+    # 旧的sha1格式，登录成功后换成新的哈希
+    if new_hash:
+        user.password = new_hash
+        await user.update()
     # authenticate ok, set cookie:
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
@@ -326,20 +407,195 @@ async def api_create_blog(request, *, name, summary, content):
     return blog
 
 
+# 编辑blog的api，只写回修改过的字段
+# version为编辑页面读取时的版本号，期间被别人修改过则拒绝保存；写操作都绕过查询缓存读取当前数据
+@post('/api/blogs/{id}')
+async def api_update_blog(id, request, *, name, summary, content, version=None):
+    check_admin(request)
+    blog = await Blog.find(id, cache=False)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    if not name or not name.strip():
+        raise APIValueError('name', 'name cannot be empty.')
+    if not summary or not summary.strip():
+        raise APIValueError('summary', 'summary cannot be empty.')
+    if not content or not content.strip():
+        raise APIValueError('content', 'content cannot be empty.')
+    if version is not None and str(version) != str(blog.version):
+        raise APIError('blog:conflict', 'version', 'Blog has been modified by someone else.')
+    blog.name = name.strip()
+    blog.summary = summary.strip()
+    blog.content = content.strip()
+    try:
+        await blog.update()
+    except StaleObjectError:
+        raise APIError('blog:conflict', 'version', 'Blog has been modified by someone else.')
+    return blog
+
+
+# blog列表的一页（不含content），前几页直接取自首页的物化视图
+async def blog_page(page_index, total=None):
+    if configs.get('frontpage', {}).get('enabled', True):
+        from webapp.www import frontpage
+        cached = frontpage.page(page_index, PAGE_SIZE)
+        if cached is not None:
+            return cached
+    blogs, num = await Blog.find_page(page_index, PAGE_SIZE, order_by='created_at desc, id desc', total=total)
+    # 缓存的页中评论数可能是旧的，用计数器的当前值
+    counts = await Blog.find_counters([blog.id for blog in blogs], 'comment_count')
+    for blog in blogs:
+        blog.pop('content', None)
+        blog.comment_count = counts.get(blog.id, blog.comment_count)
+    return blogs, num
+
+
 # 分页查询blog列表的api
-@get('/api/blogs')
-async def api_blogs(*, page='1'):
+# 评论数由计数器维护，不改变blogs表的版本号，ETag还要依赖计数器的版本号
+@get('/api/blogs', etag=['blogs', orm.counter_key('blogs')], cache_control='private, no-cache')
+async def api_blogs(*, page='1', total=None):
     page_index = get_page_index(page)
-    num = await Blog.find_number('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
+    blogs, num = await blog_page(page_index, get_total(total))
+    p = Page(num, page_index, PAGE_SIZE)
+    if num == 0 or page_index > p.page_count:
         return dict(page=p, blogs=())
-    blogs = await Blog.find_all(order_by='created_at desc', limit=(p.offset, p.limit))
     return dict(page=p, blogs=blogs)
 
 
+# 删除blog的api
+@post('/api/blogs/{id}/delete')
+async def api_delete_blog(id, request):
+    check_admin(request)
+    blog = await Blog.find(id, cache=False)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    await blog.remove()
+    return dict(id=id)
+
+
+# 批量调用多个GET api：{"requests": [{"path": "/api/blogs?page=2"}, ...]}
+# 子请求共用本次请求的认证，和普通请求一样经过路由级准入控制和ETag检查，并发执行，
+# 按顺序返回[{"path", "status", "body", "etag"}]
+@post('/api/batch')
+async def api_batch(request, *, requests):
+    conf = configs.get('batch', {})
+    if not isinstance(requests, list) or not requests:
+        raise APIValueError('requests', 'requests must be a non-empty list.')
+    if len(requests) > conf.get('max_requests', 20):
+        raise APIValueError('requests', 'at most %s requests per batch.' % conf.get('max_requests', 20))
+    calls = []
+    for r in requests:
+        path = r.get('path') if isinstance(r, dict) else r
+        method = (r.get('method') or 'GET').upper() if isinstance(r, dict) else 'GET'
+        if not isinstance(path, str) or not path.startswith('/api/') or path.startswith('/api/batch'):
+            raise APIValueError('requests', 'invalid path: %s' % path)
+        if method != 'GET':
+            raise APIValueError('requests', 'only GET requests can be batched.')
+        # 每个子请求可以带上次返回的etag，未修改时status为304，body为空
+        calls.append((path, r.get('etag') if isinstance(r, dict) else None))
+
+    async def call(path, etag):
+        try:
+            status, body, etag = await call_sub_request(request, 'GET', path, etag)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(e)
+            status, body, etag = 500, None, None
+        return dict(path=path, status=status, body=body, etag=etag)
+
+    results = await orm.gather(*[call(path, etag) for path, etag in calls], limit=conf.get('concurrency', 4))
+    return web.Response(body=json.dumps(results, ensure_ascii=False).encode('utf-8'),
+                        content_type='application/json', charset='utf-8')
+
+
 # 要编辑的blog信息查询api
-@get('/api/blogs/{id}')
+@get('/api/blogs/{id}', etag=['blogs', orm.counter_key('blogs')], cache_control='private, no-cache')
 async def api_get_blog(*, id):
-    blog = await Blog.find(id)
+    blog, comment_count = await orm.gather(Blog.find(id), Blog.find_counter(id, 'comment_count'))
+    if blog is not None:
+        blog.comment_count = comment_count or 0
     return blog
+
+
+# Atom订阅
+@get('/feed.atom')
+async def feed_atom(request):
+    return await syndication.feed_response(request, 'atom')
+
+
+# RSS订阅
+@get('/feed.rss')
+async def feed_rss(request):
+    return await syndication.feed_response(request, 'rss')
+
+
+# 搜索blog和评论
+@get('/api/search')
+def api_search(*, q='', page='1'):
+    page_index = get_page_index(page)
+    page_size = 20
+    if not configs.get('search', {}).get('enabled', True):
+        return dict(q=q, page_index=page_index, results=[])
+    from webapp.www import search
+    results = search.search(q, limit=page_size, offset=page_size * (page_index - 1))
+    return dict(q=q, page_index=page_index, results=results)
+
+
+# 准入控制的队列深度、拒绝次数等统计
+@get('/manage/admission')
+def manage_admission(request):
+    check_admin(request)
+    return admission.stats()
+
+
+# 查询缓存的命中率等统计
+@get('/manage/cache')
+def manage_cache(request):
+    check_admin(request)
+    stats = orm.cache_stats()
+    stats['fragments'] = fragments.stats()
+    return stats
+
+
+# 对运行时出现过的SQL执行EXPLAIN，列出全表扫描、filesort
+@get('/manage/explain')
+async def manage_explain(request):
+    check_admin(request)
+    from webapp.www import ddl
+    return dict(queries=await ddl.explain_queries())
+
+
+# Prometheus文本格式的指标
+@get('/manage/metrics')
+def manage_metrics(request):
+    check_admin(request)
+    return web.Response(text=metrics.registry.render(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+                                 'Cache-Control': 'no-cache'})
+
+
+# 采样seconds秒，返回collapsed stack格式，可直接交给flamegraph.pl；kind=alloc时为各调用栈新分配的字节数
+@get('/manage/debug/profile', timeout=configs.get('diagnostics', {}).get('max_profile_seconds', 60) + 5)
+async def manage_debug_profile(request, *, seconds='10', kind='cpu'):
+    check_admin(request)
+    if kind not in ('cpu', 'alloc'):
+        raise APIValueError('kind', 'kind must be cpu or alloc.')
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        raise APIValueError('seconds', 'seconds must be a number.')
+    from webapp.www import diagnostics
+    try:
+        stacks = await diagnostics.profile(seconds, kind)
+    except RuntimeError as e:
+        raise APIError('profile:busy', kind, str(e))
+    return web.Response(text=stacks, content_type='text/plain', charset='utf-8',
+                        headers={'Cache-Control': 'no-cache'})
+
+
+# 最近几次事件循环被阻塞的时长、路由和调用栈
+@get('/manage/debug/blocks')
+def manage_debug_blocks(request):
+    check_admin(request)
+    from webapp.www import diagnostics
+    return dict(blocks=list(diagnostics.recent_blocks))
@@ -0,0 +1,281 @@
+"""
+进程内的异步任务队列：把写请求的附带工作（建索引、预热缓存等）移出请求处理
+
+- 任务按名字注册：@register('search.index') async def fn(**payload)，用enqueue(name, **payload)提交
+- 优先级high/normal/low，同时执行的任务数有上限
+- 失败后按指数退避重试，超过max_attempts次记日志后放弃
+- 每个任务的提交、重试、完成追加写入spool文件（每行一个JSON），重启时读回尚未完成的任务；
+  已完成的记录过多时重写spool文件
+- 关闭时等待已就绪的任务执行完（最多drain_timeout秒），剩下的留在spool中下次启动再执行
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import time
+
+from webapp.www import metrics
+from webapp.www.config import configs
+
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+JOBS = metrics.registry.register(metrics.Counter('jobs_total', 'Finished jobs by result.', ('job', 'result')))
+JOB_LATENCY = metrics.registry.register(metrics.Histogram('job_latency_seconds',
+                                                          'Time from enqueue to the end of the last attempt.',
+                                                          ('job',)))
+JOB_RUN_TIME = metrics.registry.register(metrics.Histogram('job_run_seconds', 'Time spent running a job.',
+                                                           ('job',)))
+
+_handlers = {}
+_seq = itertools.count()
+# 已就绪：(优先级, 序号, job)；等待重试：(执行时间, 序号, job)
+_ready = []
+_delayed = []
+# 尚未完成的任务：id -> job
+_pending = {}
+_running = 0
+_wakeup = None
+_workers = []
+_spool = None
+_spool_done = 0
+_accepting = False
+
+
+def _config():
+    return configs.get('jobs', {})
+
+
+def register(name):
+    def decorator(fn):
+        _handlers[name] = fn
+        return fn
+
+    return decorator
+
+
+def stats():
+    return dict(ready=len(_ready), delayed=len(_delayed), running=_running, pending=len(_pending),
+                workers=len(_workers))
+
+
+def _queue_metrics():
+    s = stats()
+    yield 'jobs_queue_depth', 'gauge', 'Jobs waiting to run.', [
+        (dict(state='ready'), s['ready']), (dict(state='delayed'), s['delayed'])]
+    yield 'jobs_running', 'gauge', 'Jobs currently running.', [({}, s['running'])]
+
+
+metrics.registry.add_collector(_queue_metrics)
+
+
+# -------- spool文件 --------
+
+def _write(record):
+    global _spool_done
+    if _spool is None:
+        return
+    _spool.write(json.dumps(record, ensure_ascii=False) + '\n')
+    _spool.flush()
+    if record['op'] in ('done', 'failed'):
+        _spool_done += 1
+        if _spool_done >= _config().get('compact_after', 1000):
+            _compact()
+
+
+def _open_spool(path):
+    global _spool
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    _spool = open(path, 'a', encoding='utf-8')
+
+
+# 用尚未完成的任务重写spool文件
+def _compact():
+    global _spool, _spool_done
+    path = _spool.name
+    _spool.close()
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for job in _pending.values():
+            f.write(json.dumps(dict(job, op='add'), ensure_ascii=False) + '\n')
+    os.replace(tmp, path)
+    _spool_done = 0
+    _open_spool(path)
+
+
+# 读回spool中尚未完成的任务
+def _load_spool(path):
+    jobs = {}
+    if not os.path.exists(path):
+        return jobs
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 写到一半时进程退出，最后一行可能不完整
+                continue
+            op = record.pop('op', None)
+            if op == 'add':
+                jobs[record['id']] = record
+            elif op == 'retry' and record['id'] in jobs:
+                jobs[record['id']].update(attempts=record['attempts'], run_at=record['run_at'])
+            elif op in ('done', 'failed'):
+                jobs.pop(record['id'], None)
+    return jobs
+
+
+# -------- 提交与调度 --------
+
+def _schedule(job):
+    if job['run_at'] > time.time():
+        heapq.heappush(_delayed, (job['run_at'], next(_seq), job))
+    else:
+        heapq.heappush(_ready, (PRIORITIES.get(job['priority'], 1), next(_seq), job))
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+# 提交任务，payload须能JSON序列化；delay秒后才执行。返回任务id
+def enqueue(name, *, priority='normal', delay=0, **payload):
+    if name not in _handlers:
+        raise ValueError('unknown job: %s' % name)
+    now = time.time()
+    job = dict(id='%s-%s' % (int(now * 1000), next(_seq)), name=name, payload=payload, priority=priority,
+               attempts=0, enqueued_at=now, run_at=now + delay)
+    _pending[job['id']] = job
+    _write(dict(job, op='add'))
+    if not _config().get('enabled', True):
+        # 不使用任务队列时直接在后台执行。在空的上下文中创建任务，不继承请求的截止时间（deadline的contextvar），
+        # 否则响应返回后任务仍可能因请求超时被中断
+        contextvars.Context().run(asyncio.ensure_future, _run_inline(job))
+    else:
+        _schedule(job)
+    return job['id']
+
+
+# 不使用任务队列时执行任务：没有worker，失败后在同一个任务中等待退避时间再重试
+async def _run_inline(job):
+    while job['id'] in _pending:
+        delay = job['run_at'] - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await _run(job)
+
+
+def _next_job():
+    now = time.time()
+    while _delayed and _delayed[0][0] <= now:
+        _, _, job = heapq.heappop(_delayed)
+        heapq.heappush(_ready, (PRIORITIES.get(job['priority'], 1), next(_seq), job))
+    if _ready:
+        return heapq.heappop(_ready)[2]
+    return None
+
+
+async def _run(job):
+    global _running
+    name = job['name']
+    _running += 1
+    start = time.time()
+    try:
+        await _handlers[name](**job['payload'])
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        job['attempts'] += 1
+        if job['attempts'] >= _config().get('max_attempts', 5):
+            logging.exception('job %s %s failed after %s attempts: %s' % (name, job['id'], job['attempts'], e))
+            _finish(job, 'failed')
+            return
+        backoff = _config().get('backoff', 1.0) * 2 ** (job['attempts'] - 1)
+        job['run_at'] = time.time() + backoff * random.uniform(0.5, 1.5)
+        logging.warning('job %s %s failed (%s), retry in %.1fs' % (name, job['id'], e, job['run_at'] - time.time()))
+        JOBS.inc(name, 'retry')
+        _write(dict(op='retry', id=job['id'], attempts=job['attempts'], run_at=job['run_at']))
+        if _config().get('enabled', True):
+            _schedule(job)
+    else:
+        _finish(job, 'done')
+    finally:
+        _running -= 1
+        JOB_RUN_TIME.observe(name, value=time.time() - start)
+
+
+def _finish(job, result):
+    _pending.pop(job['id'], None)
+    _write(dict(op=result, id=job['id']))
+    JOBS.inc(job['name'], result)
+    JOB_LATENCY.observe(job['name'], value=time.time() - job['enqueued_at'])
+
+
+async def _worker():
+    while True:
+        job = _next_job()
+        if job is None:
+            if not _accepting:
+                return
+            _wakeup.clear()
+            timeout = _delayed[0][0] - time.time() if _delayed else None
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _run(job)
+
+
+# 在app启动时调用：读回spool中未完成的任务，启动worker；关闭时排空已就绪的任务
+def init(app):
+    global _wakeup, _accepting
+    conf = _config()
+    if not conf.get('enabled', True):
+        return
+    path = conf.get('spool')
+    if path:
+        for job in _load_spool(path).values():
+            if job['name'] in _handlers:
+                _pending[job['id']] = job
+                _schedule(job)
+            else:
+                logging.warning('dropping job %s: unknown job name %s' % (job['id'], job['name']))
+        _open_spool(path)
+        _compact()
+        if _pending:
+            logging.info('jobs: %s jobs restored from %s' % (len(_pending), path))
+    _wakeup = asyncio.Event()
+    _accepting = True
+    _workers[:] = [asyncio.ensure_future(_worker()) for _ in range(conf.get('concurrency', 4))]
+
+    async def on_shutdown(app):
+        await drain(conf.get('drain_timeout', 10))
+
+    app.on_shutdown.append(on_shutdown)
+
+
+# 等待已就绪和正在执行的任务全部完成（不包括等待重试的）
+async def join():
+    while _ready or _running:
+        await asyncio.sleep(0.01)
+
+
+# 不再等待新任务，执行完已就绪的任务后退出；超时则取消，未完成的任务保留在spool中
+async def drain(timeout):
+    global _accepting, _spool
+    _accepting = False
+    if _wakeup is not None:
+        _wakeup.set()
+    if _workers:
+        done, pending = await asyncio.wait(_workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning('jobs: %s jobs left in the queue' % len(_pending))
+    _workers[:] = []
+    if _spool is not None:
+        _spool.close()
+        _spool = None
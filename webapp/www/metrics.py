@@ -0,0 +1,209 @@
+"""
+HTTP层的指标：按路由模板统计的延迟直方图、响应大小、进行中的请求数，以Prometheus文本格式输出
+"""
+
+import bisect
+import time
+
+from aiohttp import web
+
+from webapp.www import admission, orm
+from webapp.www.coroweb import route_of
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for n, v in zip(names, values)]
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return repr(v) if isinstance(v, float) else str(v)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, v in self._values.items():
+            yield self.name, _format_labels(self.labels, labels), v
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) - value
+
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # labels -> [各桶计数..., 总和, 总数]
+        self._values = {}
+
+    def observe(self, *labels, value):
+        v = self._values.get(labels)
+        if v is None:
+            v = self._values[labels] = [0] * (len(self.buckets) + 2)
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            v[i] += 1
+        v[-2] += value
+        v[-1] += 1
+
+    def samples(self):
+        for labels, v in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, v):
+                cumulative += count
+                yield self.name + '_bucket', _format_labels(self.labels + ('le',), labels + (
+                    _format_value(float(bound)),)), cumulative
+            yield self.name + '_bucket', _format_labels(self.labels + ('le',), labels + ('+Inf',)), v[-1]
+            yield self.name + '_sum', _format_labels(self.labels, labels), v[-2]
+            yield self.name + '_count', _format_labels(self.labels, labels), v[-1]
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        # 抓取时才计算的指标：fn() -> [(name, type, help, [(labels dict, value)])]
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, fn):
+        self._collectors.append(fn)
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.append('# HELP %s %s' % (m.name, m.help))
+            lines.append('# TYPE %s %s' % (m.name, m.type))
+            for name, labels, value in m.samples():
+                lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        for fn in self._collectors:
+            for name, type, help, samples in fn():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+                for labels, value in samples:
+                    lines.append('%s%s %s' % (name, _format_labels(tuple(labels.keys()), tuple(labels.values())),
+                                              _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter('http_requests_total', 'HTTP requests.', ('method', 'route', 'status')))
+IN_FLIGHT = registry.register(Gauge('http_requests_in_flight', 'HTTP requests in progress.', ('route',)))
+LATENCY = registry.register(Histogram('http_request_duration_seconds', 'Total request latency.',
+                                      ('method', 'route')))
+HANDLER_TIME = registry.register(Histogram('http_handler_duration_seconds', 'Time spent in the URL handler.',
+                                           ('route',)))
+RENDER_TIME = registry.register(Histogram('http_render_duration_seconds',
+                                          'Time spent building the response in response_factory.', ('route',)))
+RESPONSE_SIZE = registry.register(Histogram('http_response_size_bytes', 'Response body size.', ('route',),
+                                            buckets=SIZE_BUCKETS))
+
+
+# 记录每个请求的指标的middleware，放在最外层
+async def metrics_factory(app, handler):
+    async def metrics(request):
+        route = route_of(request)
+        IN_FLIGHT.inc(route)
+        start = time.perf_counter()
+        status = 500
+        resp = None
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            IN_FLIGHT.dec(route)
+            LATENCY.observe(request.method, route, value=time.perf_counter() - start)
+            REQUESTS.inc(request.method, route, str(status))
+            if resp is not None:
+                size = resp.body_length if hasattr(resp, 'body_length') and resp.prepared else None
+                if size is None:
+                    size = resp.content_length or 0
+                RESPONSE_SIZE.observe(route, value=size)
+
+    return metrics
+
+
+# 准入控制、连接池、查询缓存已有的统计，抓取时转换为指标
+def _subsystem_metrics():
+    gates = admission.stats()
+    yield 'admission_active', 'gauge', 'Requests holding an admission slot.', [
+        (dict(gate=name), s['active']) for name, s in gates.items()]
+    yield 'admission_queued', 'gauge', 'Requests waiting for an admission slot.', [
+        (dict(gate=name), s['queued']) for name, s in gates.items()]
+    for key in ('admitted', 'rejected', 'timeouts'):
+        yield 'admission_%s_total' % key, 'counter', 'Admission %s.' % key, [
+            (dict(gate=name), s[key]) for name, s in gates.items()]
+    yield 'admission_wait_seconds_total', 'counter', 'Time spent waiting for admission.', [
+        (dict(gate=name), s['wait_seconds']) for name, s in gates.items()]
+
+    pool = orm.pool_stats()
+    for key in ('size', 'free', 'maxsize'):
+        if key in pool:
+            yield 'db_pool_%s' % key, 'gauge', 'Connection pool %s.' % key, [({}, pool[key])]
+    for key in ('acquired', 'pings', 'timeouts', 'killed', 'grown', 'shrunk', 'wait_seconds'):
+        yield 'db_pool_%s_total' % key, 'counter', 'Connection pool %s.' % key.replace('_', ' '), [({}, pool[key])]
+
+    cache = orm.cache_stats()
+    yield 'query_cache_entries', 'gauge', 'Query cache entries.', [({}, cache['entries'])]
+    yield 'query_cache_bytes', 'gauge', 'Estimated query cache size.', [({}, cache['bytes'])]
+    yield 'query_cache_evictions_total', 'counter', 'Query cache evictions.', [({}, cache['evictions'])]
+    yield 'query_cache_hits_total', 'counter', 'Query cache hits.', [
+        (dict(table=t), s['hits']) for t, s in cache['tables'].items()]
+    yield 'query_cache_misses_total', 'counter', 'Query cache misses.', [
+        (dict(table=t), s['misses']) for t, s in cache['tables'].items()]
+    shared = cache.get('shared')
+    if shared is not None:
+        for key in ('hits', 'misses', 'sets', 'too_large'):
+            yield 'shared_cache_%s_total' % key, 'counter', 'Shared cache %s.' % key.replace('_', ' '), [
+                ({}, shared[key])]
+
+
+registry.add_collector(_subsystem_metrics)
+
+
+# response_factory中分别记录URL处理函数和构造响应（模板渲染、JSON序列化）的耗时
+def observe_handler(request, seconds):
+    HANDLER_TIME.observe(route_of(request), value=seconds)
+
+
+def observe_render(request, seconds):
+    RENDER_TIME.observe(route_of(request), value=seconds)
@@ -0,0 +1,103 @@
+"""
+把旧的50位varchar主键（15位毫秒时间戳+uuid4+000）迁移为bigint的时间有序ID
+
+新ID按每行的created_at生成，保持原有的时间顺序；blogs.user_id、comments.blog_id、comments.user_id同步改写。
+旧格式的口令哈希以旧的用户id做盐，迁移时改写为sha1$<旧id>$<hash>，用户下次登录时会自动升级为新的哈希。
+用法：
+    python -m webapp.www.migrate_ids --dry-run    # 只打印要执行的SQL
+    python -m webapp.www.migrate_ids
+迁移前请先备份数据库，迁移期间应停止写入。
+"""
+
+import asyncio
+import sys
+
+from webapp.www import orm
+from webapp.www.config import configs
+from webapp.www.models import make_id, ID_EPOCH, MAX_SEQUENCE
+
+# 表 -> 需要改写的外键列 -> 引用的表
+TABLES = [
+    ('users', {}),
+    ('blogs', {'user_id': 'users'}),
+    ('comments', {'blog_id': 'blogs', 'user_id': 'users'}),
+]
+
+
+def prepare_sql():
+    sql = []
+    for table, fks in TABLES:
+        columns = ['add column `new_id` bigint null'] + ['add column `new_%s` bigint null' % c for c in fks]
+        sql.append('alter table `%s` %s' % (table, ', '.join(columns)))
+    # sha1$<旧id>$<hash>约96个字符，旧表的varchar(50)放不下，先加宽
+    sql.append('alter table `users` modify `password` varchar(200) not null')
+    return sql
+
+
+def foreign_key_sql():
+    sql = []
+    for table, fks in TABLES:
+        for column, ref in fks.items():
+            sql.append('update `%s` t join `%s` r on t.`%s`=r.`id` set t.`new_%s`=r.`new_id`' % (
+                table, ref, column, column))
+    # 旧口令哈希依赖旧的用户id，把盐显式保存下来
+    sql.append("update `users` set `password`=concat('sha1$', `id`, '$', `password`) "
+               "where `password` regexp '^[0-9a-f]{40}$'")
+    return sql
+
+
+def swap_sql():
+    sql = []
+    for table, fks in TABLES:
+        parts = ['drop primary key', 'drop column `id`', 'change `new_id` `id` bigint not null']
+        for column in fks:
+            parts.append('drop column `%s`' % column)
+            parts.append('change `new_%s` `%s` bigint not null' % (column, column))
+        parts.append('add primary key (`id`)')
+        sql.append('alter table `%s` %s' % (table, ', '.join(parts)))
+    return sql
+
+
+# 按created_at顺序给每行分配新ID，同一毫秒内用序号区分
+async def assign_ids(table, dry_run):
+    rows = await orm.select('select `id`, `created_at` from `%s` order by `created_at`, `id`' % table, [])
+    # 早于ID_EPOCH的行会得到负数ID，user2cookie用'-'拼接后cookie2user再也解析不了
+    if rows and int(rows[0]['created_at'] * 1000) < ID_EPOCH:
+        raise ValueError('%s has rows created before ID_EPOCH (id=%s), move ID_EPOCH earlier' % (table, rows[0]['id']))
+    last_ms, seq = 0, 0
+    for row in rows:
+        ms = int(row['created_at'] * 1000)
+        if ms > last_ms:
+            last_ms, seq = ms, 0
+        elif seq < MAX_SEQUENCE:
+            seq += 1
+        else:
+            last_ms, seq = last_ms + 1, 0
+        new_id = make_id(last_ms, 0, seq)
+        if dry_run:
+            continue
+        await orm.execute('update `%s` set `new_id`=? where `id`=?' % table, [new_id, row['id']])
+    print('-- %s: %s rows' % (table, len(rows)))
+
+
+async def migrate(loop, dry_run=False):
+    async def run(statements):
+        for sql in statements:
+            print(sql + ';')
+            if not dry_run:
+                await orm.execute(sql, [])
+
+    await orm.create_pool(loop=loop, **configs.db)
+    try:
+        await run(prepare_sql())
+        for table, _ in TABLES:
+            await assign_ids(table, dry_run)
+        await run(foreign_key_sql())
+        await run(swap_sql())
+    finally:
+        await orm.close_pool()
+
+
+if '__main__' == __name__:
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(loop, dry_run='--dry-run' in sys.argv[1:]))
@@ -1,19 +1,68 @@
-import uuid
+import threading
 import time
-from webapp.www.orm import Model, StringField, BooleanField, FloatField, TextField
 
+from webapp.www.config import configs
+from webapp.www.orm import Model, StringField, BooleanField, FloatField, TextField, IdField, IntegerField, Index
 
+# ID的组成（共53位，JS的Number也能精确表示）：
+# 41位 自ID_EPOCH起的毫秒数 | 4位 worker编号 | 8位 同一毫秒内的序号
+# ID_EPOCH必须早于库里最早的一行（已有数据从2017年开始），否则迁移出来的ID是负数，cookie里的'-'分隔就会错乱
+ID_EPOCH = 1262304000000  # 2010-01-01 00:00:00 UTC
+WORKER_BITS = 4
+SEQUENCE_BITS = 8
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+_id_lock = threading.Lock()
+_last_ms = 0
+_sequence = 0
+
+
+# 单进程部署不设置worker时用0；多进程部署由check_worker_id保证已经设置
+def _worker_id():
+    worker = configs.get('ids', {}).get('worker')
+    return 0 if worker is None else worker
+
+
+# 启动时检查worker编号：多个进程写同一个数据库时，每个进程必须配置不同的ids.worker，否则会生成重复的主键
+def check_worker_id():
+    conf = configs.get('ids', {})
+    worker = conf.get('worker')
+    if worker is None:
+        if conf.get('processes', 1) > 1 or configs.get('shared_cache', {}).get('enabled'):
+            raise ValueError('configs.ids.worker must be set to a distinct value for each process '
+                             'when several processes write to the database')
+        return
+    if not isinstance(worker, int) or not 0 <= worker < (1 << WORKER_BITS):
+        raise ValueError('configs.ids.worker must be an integer in [0, %s]: %r' % ((1 << WORKER_BITS) - 1, worker))
+
+
+def make_id(ms, worker, sequence):
+    return ((ms - ID_EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence
+
+
+# 单调递增：同一毫秒内序号用完，或时钟回拨时，沿用上一个毫秒数继续往后排
 def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+    global _last_ms, _sequence
+    with _id_lock:
+        ms = int(time.time() * 1000)
+        if ms > _last_ms:
+            _last_ms, _sequence = ms, 0
+        elif _sequence < MAX_SEQUENCE:
+            _sequence += 1
+        else:
+            _last_ms, _sequence = _last_ms + 1, 0
+        return str(make_id(_last_ms, _worker_id(), _sequence))
 
 
 # User Model
 class User(Model):
     __table__ = 'users'
+    __cache_ttl__ = 30
+    __indexes__ = [Index('email', unique=True), Index('created_at')]
 
-    id = StringField(primary_key=True, default=next_id, column_type='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
     email = StringField(column_type='varchar(50)')
-    password = StringField(column_type='varchar(50)')
+    password = StringField(column_type='varchar(200)')
     admin = BooleanField()
     name = StringField(column_type='varchar(50)')
     image = StringField(column_type='varchar(500)')
@@ -23,25 +72,36 @@ class User(Model):
 # Blog Model
 class Blog(Model):
     __table__ = 'blogs'
+    __cache_ttl__ = 60
+    __version__ = 'version'
+    __indexes__ = [Index('created_at')]
 
-    id = StringField(primary_key=True, default=next_id, column_type='varchar(50)')
-    user_id = StringField(column_type='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    user_id = IdField()
     user_name = StringField(column_type='varchar(50)')
     user_image = StringField(column_type='varchar(500)')
     name = StringField(column_type='varchar(50)')
     summary = StringField(column_type='varchar(200)')
-    content = TextField()
+    content = TextField(column_type='mediumtext')
+    version = IntegerField()
+    # 评论数，随评论的发表、删除增减，不必count(*)
+    comment_count = IntegerField()
     created_at = FloatField(default=time.time)
 
 
 # Comment Model
 class Comment(Model):
     __table__ = 'comments'
+    __cache_ttl__ = 60
+    # 博客页面按blog_id过滤、按created_at倒序
+    __indexes__ = [Index('blog_id', 'created_at'), Index('created_at')]
 
-    id = StringField(primary_key=True, default=next_id, column_type='varchar(50)')
-    blog_id = StringField(column_type='varchar(50)')
-    user_id = StringField(column_type='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    blog_id = IdField()
+    user_id = IdField()
     user_name = StringField(column_type='varchar(50)')
     user_image = StringField(column_type='varchar(500)')
-    content = TextField()
+    content = TextField(column_type='mediumtext')
+    # 发表时由content转换好的HTML，显示时不再转换
+    html_content = TextField(column_type='mediumtext', default='')
     created_at = FloatField(default=time.time)
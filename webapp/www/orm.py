@@ -1,19 +1,56 @@
+import asyncio
+import contextlib
+import inspect
 import logging
+import re
+import time
 
 import aiomysql
 
+from webapp.www import deadline
+from webapp.www.cache import LRUCache
+from webapp.www.config import configs
+
+__pool = None
+# 连接池配置，以及单独建连接（如KILL QUERY）时用的连接参数
+_pool_conf = {}
+_connect_kw = {}
+_governor = None
+_pool_stats = dict(acquired=0, wait_seconds=0.0, pings=0, timeouts=0, killed=0, grown=0, shrunk=0)
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+# 乐观锁冲突：更新时版本号已被别人改过
+class StaleObjectError(Exception):
+    pass
+
+
+# 运行时出现过的SQL形状（带?占位符的SQL -> 一组示例参数），供EXPLAIN检查
+_query_shapes = {}
+MAX_QUERY_SHAPES = 500
+
 
 # 打印SQL语句
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
+    if sql not in _query_shapes and len(_query_shapes) < MAX_QUERY_SHAPES and \
+            sql.startswith(('select', 'update', 'delete')) and 'information_schema' not in sql:
+        _query_shapes[sql] = list(args) if isinstance(args, (list, tuple)) else args
+
+
+def query_shapes():
+    return dict(_query_shapes)
 
 
 # 创建一个全局的连接池，每个HTTP请求都可以从连接池中直接获取数据库连接
 # 使用连接池的好处是不必频繁地打开和关闭数据库连接，而是能复用就尽量复用
 async def create_pool(loop, **kw):
     logging.info("create a database connection pool...")
-    global __pool
-    __pool = await aiomysql.create_pool(
+    global __pool, _governor
+    _connect_kw.update(
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -21,20 +58,248 @@ async def create_pool(loop, **kw):
         db=kw['database'],
         charset=kw.get('charset', 'utf8'),
         autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
         loop=loop
     )
+    _pool_conf.update(
+        minsize=kw.get('minsize', 1),
+        maxsize=kw.get('maxsize', 10),
+        # 启动时预先建立的连接数
+        warmup=kw.get('warmup', kw.get('minsize', 1)),
+        # 连接空闲超过ping_after秒，交出去之前先ping一次，被MySQL wait_timeout断开的连接会自动重连
+        ping_after=kw.get('ping_after', 60),
+        # 单条SQL的超时(秒)，超时后在服务器端KILL QUERY
+        query_timeout=kw.get('query_timeout', 10),
+        # 自适应调整：每adapt_interval秒看一次平均等待时间
+        adapt_interval=kw.get('adapt_interval', 5),
+        grow_wait=kw.get('grow_wait', 0.005),
+        idle_timeout=kw.get('idle_timeout', 300),
+        window_functions=kw.get('window_functions')
+    )
+    __pool = await aiomysql.create_pool(
+        maxsize=_pool_conf['maxsize'],
+        minsize=_pool_conf['minsize'],
+        # 连接使用超过pool_recycle秒后重建，应小于MySQL的wait_timeout
+        pool_recycle=kw.get('pool_recycle', 3600),
+        **_connect_kw
+    )
+    await warm_up(_pool_conf['warmup'])
+    if _pool_conf['window_functions'] is None:
+        _pool_conf['window_functions'] = await _detect_window_functions()
+    if _pool_conf['adapt_interval']:
+        _governor = asyncio.ensure_future(_govern())
+
+
+# 窗口函数从MySQL 8.0、MariaDB 10.2开始支持
+async def _detect_window_functions():
+    rs = await select('select version() _version_', [])
+    version = rs[0]['_version_']
+    m = re.match(r'(\d+)\.(\d+)', version)
+    if m is None:
+        return False
+    major, minor = int(m.group(1)), int(m.group(2))
+    if 'mariadb' in version.lower():
+        return (major, minor) >= (10, 2)
+    return major >= 8
+
+
+# 分页是否用窗口函数：连接池创建时检测的结果优先，其次是configs.db.window_functions
+def window_functions():
+    window = _pool_conf.get('window_functions')
+    if window is None:
+        window = configs.db.get('window_functions')
+    return bool(window)
+
+
+# 关闭连接池，等待所有连接释放
+async def close_pool():
+    global __pool, _governor
+    if _governor is not None:
+        _governor.cancel()
+        _governor = None
+    if __pool is not None:
+        __pool.close()
+        await __pool.wait_closed()
+        __pool = None
+
+
+# 把连接池预热到size个连接，首个请求高峰不用再临时建连接
+# aiomysql总是先交出空闲连接，没有空闲连接时才新建，所以要一直占用取到的连接，直到池中的连接数达到size
+async def warm_up(size):
+    size = min(size, __pool.maxsize)
+    held = []
+    try:
+        while __pool.size < size:
+            held.append(await __pool.acquire())
+    except Exception as e:
+        logging.warning('warm up connection failed: %s' % e)
+    finally:
+        for conn in held:
+            await __pool.release(conn)
+    logging.info('connection pool warmed up to %s' % __pool.size)
+
+
+# 连接空闲的秒数，用aiomysql记录的最后使用时间（loop.time()）
+def _idle_seconds(conn):
+    return asyncio.get_event_loop().time() - conn.last_usage
+
+
+# 关闭空闲超过idle_timeout的多余连接，最少保留minsize个
+# 只处理池中已经空闲的连接：aiomysql没有公开的接口，直接从空闲队列中移除，不经过acquire，
+# 不会因此新建连接，也不会拿走请求正要用的连接
+def shrink():
+    free = __pool._free
+    for conn in list(free):
+        if __pool.size <= _pool_conf['minsize']:
+            break
+        if _idle_seconds(conn) > _pool_conf['idle_timeout']:
+            free.remove(conn)
+            conn.close()
+            _pool_stats['shrunk'] += 1
+
+
+# 根据观察到的等待时间伸缩连接池：等待变长就提前建连接，长时间没有等待就回收空闲连接
+async def _govern():
+    acquired, waited = _pool_stats['acquired'], _pool_stats['wait_seconds']
+    while True:
+        await asyncio.sleep(_pool_conf['adapt_interval'])
+        try:
+            n = _pool_stats['acquired'] - acquired
+            avg_wait = (_pool_stats['wait_seconds'] - waited) / n if n else 0.0
+            acquired, waited = _pool_stats['acquired'], _pool_stats['wait_seconds']
+            if avg_wait > _pool_conf['grow_wait'] and __pool.size < __pool.maxsize:
+                before = __pool.size
+                await warm_up(min(__pool.maxsize, before + max(1, before // 2)))
+                _pool_stats['grown'] += __pool.size - before
+            elif avg_wait == 0.0:
+                shrink()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(e)
+
+
+def pool_stats():
+    stats = dict(_pool_stats)
+    if __pool is not None:
+        stats.update(size=__pool.size, free=__pool.freesize, maxsize=__pool.maxsize)
+    return stats
+
+
+# 本条SQL可用的时间：query_timeout和请求剩余时间中较小的一个
+def _query_timeout():
+    timeout = _pool_conf.get('query_timeout')
+    left = deadline.check()
+    if left is not None and (not timeout or left < timeout):
+        return left
+    return timeout
+
+
+# 在timeout秒内从连接池取一个连接
+# acquire在单独的任务中执行：超时或被取消时，如果acquire恰好已经完成，把取到的连接还回去，不会泄漏
+async def _acquire_within(timeout):
+    task = asyncio.ensure_future(__pool.acquire())
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except BaseException:
+        task.cancel()
+        task.add_done_callback(_release_acquired)
+        raise
+
+
+def _release_acquired(task):
+    if not task.cancelled() and task.exception() is None:
+        __pool.release(task.result())
+
+
+# 从连接池取一个连接，记录等待时间，空闲过久的连接先ping
+# 请求设置了截止时间时，等连接的时间也不会超过剩余时间
+@contextlib.asynccontextmanager
+async def connection():
+    start = time.monotonic()
+    left = deadline.check()
+    if left is None:
+        conn = await __pool.acquire()
+    else:
+        try:
+            conn = await _acquire_within(left)
+        except asyncio.TimeoutError:
+            raise deadline.DeadlineExceeded('request deadline exceeded while waiting for a connection')
+    now = time.monotonic()
+    _pool_stats['acquired'] += 1
+    _pool_stats['wait_seconds'] += now - start
+    try:
+        if _idle_seconds(conn) > _pool_conf.get('ping_after', 60):
+            _pool_stats['pings'] += 1
+            await conn.ping(reconnect=True)
+        yield conn
+    finally:
+        await __pool.release(conn)
+
+
+# 并发执行互不依赖的查询，每个查询各自从连接池取连接，总耗时取决于最慢的一个而不是全部之和
+# limit限制同时进行的查询数（默认configs.db.fanout），避免一个请求占满连接池；
+# 任何一个失败时取消其余的查询，并等它们归还连接后再抛出异常
+async def gather(*aws, limit=None):
+    limit = limit or configs.db.get('fanout', 4)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        # 被取消时还在等semaphore（或还没开始执行）的查询协程从未启动，关闭它们，
+        # 否则会报"coroutine was never awaited"
+        for aw in aws:
+            if inspect.iscoroutine(aw) and inspect.getcoroutinestate(aw) == inspect.CORO_CREATED:
+                aw.close()
+
+
+# 在服务器端取消conn上正在执行的SQL，需要另开一个连接
+async def _kill_query(conn):
+    try:
+        killer = await aiomysql.connect(**_connect_kw)
+        try:
+            async with killer.cursor() as cur:
+                await cur.execute('KILL QUERY %s', (conn.thread_id(),))
+            _pool_stats['killed'] += 1
+        finally:
+            killer.close()
+    except Exception as e:
+        logging.warning('failed to kill query on connection %s: %s' % (conn.thread_id(), e))
+
+
+# 带超时地执行SQL，超时后在服务器端取消查询，并关闭这个已不可用的连接（归还时会被连接池丢弃）
+async def _execute(conn, cur, sql, args, timeout=None):
+    if timeout is None:
+        timeout = _query_timeout()
+    if not timeout:
+        return await cur.execute(sql, args)
+    try:
+        return await asyncio.wait_for(cur.execute(sql, args), timeout)
+    except asyncio.TimeoutError:
+        _pool_stats['timeouts'] += 1
+        await _kill_query(conn)
+        conn.close()
+        raise QueryTimeout('query timed out after %.3fs: %s' % (timeout, sql))
 
 
 # 封装select功能
 async def select(sql, args, size=None):
     log(sql, args)
-    async with __pool.get() as conn:
+    async with connection() as conn:
         # 以字典的形式返回查询到的结果[{},{},{}...]
         async with conn.cursor(aiomysql.DictCursor) as cur:
             # SQL语句的占位符为?，MySQL的占位符为%s，需要替换
-            await cur.execute(sql.replace('?', '%s'), args)
+            await _execute(conn, cur, sql.replace('?', '%s'), args)
             if size:
                 rs = await cur.fetchmany(size)
             else:
@@ -43,31 +308,158 @@ async def select(sql, args, size=None):
             return rs
 
 
+# 旧版本MySQL没有窗口函数时的分页查询：SQL_CALC_FOUND_ROWS和FOUND_ROWS()必须在同一个连接上执行，
+# 两条语句作为一次多语句请求发出（aiomysql默认开启CLIENT.MULTI_STATEMENTS），只有一次往返
+async def select_found_rows(sql, args):
+    log(sql, args)
+    async with connection() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await _execute(conn, cur, sql.replace('?', '%s') + '; select found_rows() _total_', args)
+            rs = await cur.fetchall()
+            await cur.nextset()
+            total = (await cur.fetchone())['_total_']
+            logging.info('rows returned:%s' % len(rs))
+            return rs, total
+
+
 # 封装insert、delete、update
 async def execute(sql, args, autocommit=True):
     log(sql, args)
-    async with __pool.get() as conn:
+    async with connection() as conn:
         # 开始一个事务
         if not autocommit:
             await conn.begin()
         try:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+                await _execute(conn, cur, sql.replace('?', '%s'), args)
                 affected = cur.rowcount
             if not autocommit:
                 # 提交事务
                 await conn.commit()
         except BaseException as e:
-            if not autocommit:
+            if not autocommit and not conn.closed:
                 # 回滚，即撤销事务里的操作
                 await conn.rollback()
             raise
-        finally:
-            # conn.close()可防止 RuntimeError: Event loop is closed
-            conn.close()
         return affected
 
 
+# 数据变更监听：Model的save/update/remove执行后回调fn(event, model)，event为'save'、'update'、'remove'，
+# Model.increment之后为'increment'（model只有主键和计数器字段）
+# 供搜索索引、缓存失效等在写入后同步更新，回调应当很轻，出错只记日志不影响写入
+_listeners = []
+
+
+def add_listener(fn):
+    _listeners.append(fn)
+
+
+def remove_listener(fn):
+    if fn in _listeners:
+        _listeners.remove(fn)
+
+
+def _notify(event, model):
+    # 计数器变化只增加计数器的版本号，依赖表版本号的查询缓存、模板片段、ETag不因此失效
+    bump_table_version(counter_key(model.__table__) if event == 'increment' else model.__table__)
+    # 通知同一台机器上的其它worker，见subscribe_remote
+    if _shared is not None:
+        _shared.publish(event, '%s:%s' % (model.__table__, model.get(model.__primary_key__)))
+    for fn in list(_listeners):
+        try:
+            fn(event, model)
+        except Exception as e:
+            logging.exception(e)
+
+
+# 表的版本号，每次通过Model写入时加1；查询缓存的条目记录读取时的版本号，版本变了即失效
+_table_versions = {}
+
+
+# 多进程部署时使用共享内存中的版本号和二级缓存，见sharedcache
+_shared = None
+
+
+def set_shared_cache(shared):
+    global _shared
+    _shared = shared
+
+
+def get_shared_cache():
+    return _shared
+
+
+# 订阅同一台机器上其它worker的写入通知fn(event, name)，name为'表:主键'；未启用共享缓存时什么也不做
+def subscribe_remote(fn):
+    if _shared is not None:
+        _shared.subscribe(fn)
+
+
+def table_version(table):
+    if _shared is not None:
+        return _shared.get_version(table)
+    return _table_versions.get(table, 0)
+
+
+# Model.increment维护的计数器字段单独的版本号
+def counter_key(table):
+    return '%s.counters' % table
+
+
+def bump_table_version(table):
+    if _shared is not None:
+        _shared.bump_version(table)
+        return
+    _table_versions[table] = _table_versions.get(table, 0) + 1
+
+
+# 查询结果缓存，只对声明了__cache_ttl__的Model生效
+_query_cache = LRUCache(max_entries=configs.get('cache', {}).get('max_entries', 10000),
+                        max_bytes=configs.get('cache', {}).get('max_bytes', 64 * 1024 * 1024))
+# 表 -> [命中次数, 未命中次数]
+_cache_counts = {}
+
+
+def cache_stats():
+    stats = _query_cache.stats()
+    # 版本号过期的条目在LRU里算命中，以按表统计的结果为准
+    stats['hits'] = sum(h for h, _ in _cache_counts.values())
+    stats['misses'] = sum(m for _, m in _cache_counts.values())
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / total if total else 0.0
+    if _shared is not None:
+        stats['shared'] = _shared.stats()
+    stats['tables'] = {t: dict(hits=h, misses=m, hit_ratio=h / (h + m) if h + m else 0.0)
+                       for t, (h, m) in _cache_counts.items()}
+    return stats
+
+
+# 带缓存的select：键为SQL+参数，值为(表版本号, 结果行)
+# 查询前后表版本不一致（期间有写入）时不缓存，避免把旧数据放进缓存
+async def cached_select(table, ttl, sql, args, size=None):
+    if not ttl:
+        return await select(sql, args, size)
+    key = (sql, tuple(args) if isinstance(args, (list, tuple)) else args, size)
+    version = table_version(table)
+    counts = _cache_counts.setdefault(table, [0, 0])
+    entry = _query_cache.get(key)
+    if entry is None and _shared is not None:
+        # 本进程没有，再看其它worker是否已经查过
+        entry = _shared.get(repr(key).encode('utf-8'))
+        if entry is not None and entry[0] == version:
+            _query_cache.set(key, entry, ttl)
+    if entry is not None and entry[0] == version:
+        counts[0] += 1
+        return entry[1]
+    counts[1] += 1
+    rs = await select(sql, args, size)
+    if table_version(table) == version:
+        _query_cache.set(key, (version, rs), ttl)
+        if _shared is not None:
+            _shared.set(repr(key).encode('utf-8'), (version, rs), ttl)
+    return rs
+
+
 # 根据要操作的字段个数，生成占位符列表
 def create_args_string(count):
     l = []
@@ -84,6 +476,13 @@ class Field(object):
         self.primary_key = primary_key
         self.default = default
 
+    # 写入数据库前、读出之后的值转换，默认原样返回
+    def to_db(self, value):
+        return value
+
+    def from_db(self, value):
+        return value
+
 
 class StringField(Field):
     def __init__(self, name=None, primary_key=False, default=None, column_type='varchar(100)'):
@@ -101,8 +500,8 @@ class FloatField(Field):
 
 
 class TextField(Field):
-    def __init__(self, name=None, primary_key=False, default=None):
-        super().__init__(name, 'text', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, column_type='text'):
+        super().__init__(name, column_type, primary_key, default)
 
 
 class BooleanField(Field):
@@ -110,6 +509,32 @@ class BooleanField(Field):
         super().__init__(name, 'boolean', primary_key, default)
 
 
+# 紧凑的时间有序ID，数据库中存为bigint，聚簇索引按插入顺序追加
+# Python中仍以十进制字符串表示，URL、cookie、JSON（JS的Number只精确到2^53）都不受影响
+class IdField(Field):
+    def __init__(self, name=None, primary_key=False, default=None):
+        super().__init__(name, 'bigint', primary_key, default)
+
+    def to_db(self, value):
+        return None if value is None else int(value)
+
+    def from_db(self, value):
+        return None if value is None else str(value)
+
+
+# 索引声明，在Model中写 __indexes__ = [Index('blog_id', 'created_at'), Index('email', unique=True)]
+class Index(object):
+    def __init__(self, *columns, name=None, unique=False):
+        if not columns:
+            raise ValueError('Index needs at least one column.')
+        self.columns = columns
+        self.name = name or 'idx_%s' % '_'.join(columns)
+        self.unique = unique
+
+    def __repr__(self):
+        return '%sIndex(%s)' % ('Unique' if self.unique else '', ', '.join(self.columns))
+
+
 # 定义元类ModelMetaclass（所有的元类都继承自type）
 # ModelMetaclass是具体Model的基类，它封装了子类的一些具体操作，继承该元类的子类都具有这些基本操作：
 # 该元类的工作主要是为一个数据库表映射成一个封装的类做准备，读取具体子类(user)的映射信息
@@ -159,21 +584,48 @@ class ModelMetaclass(type):
         attrs['__table__'] = table_name
         attrs['__primary_key__'] = primary_key
         attrs['__fields__'] = fields
+        # 需要做值转换的字段
+        attrs['__converters__'] = {k: f for k, f in mappings.items()
+                                   if type(f).to_db is not Field.to_db or type(f).from_db is not Field.from_db}
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primary_key, ', '.join(escaped_fields), table_name)
         attrs['__insert__'] = 'insert into `%s` (%s,`%s`) values (%s)' % (
             table_name, ', '.join(escaped_fields), primary_key, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (
             table_name, ', '.join(list(map(lambda f: '`%s`=?' % f, fields))), primary_key)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name, primary_key)
+        # 乐观锁的版本号字段，由子类通过__version__ = '字段名'声明
+        version = attrs.get('__version__', None)
+        if version is not None and version not in fields:
+            raise AttributeError('Version field not found: %s' % version)
+        attrs['__version__'] = version
+        indexes = list(attrs.get('__indexes__', ()))
+        for index in indexes:
+            for column in index.columns:
+                if column not in mappings:
+                    raise AttributeError('Index %s: column not found: %s' % (index.name, column))
+        attrs['__indexes__'] = indexes
         return type.__new__(mcs, name, bases, attrs)
 
 
 # 定义数据库Model的基类，封装数据库操作
 # 继承dict，则拥有字典的功能d[key]
 # 同时重写了__getattr__()、__setattr__()方法，可以通过点号操作属性d.key
+# 记录自从数据库读出（或上次写入）以来修改过的字段，update()只写这些字段
+# 声明__cache_ttl__（秒）的Model，find_all/find/find_number的结果会被缓存，表有写入时自动失效
 class Model(dict, metaclass=ModelMetaclass):
+    __cache_ttl__ = 0
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        # 不放在dict里，避免被序列化成JSON
+        object.__setattr__(self, '_dirty', set(k for k in kw if k in self.__mappings__))
+        object.__setattr__(self, '_loaded', False)
+
+    def __setitem__(self, key, value):
+        # 值没有变化时不算修改
+        if key in self.__mappings__ and (key not in self or dict.__getitem__(self, key) != value):
+            self._dirty.add(key)
+        super(Model, self).__setitem__(key, value)
 
     def __getattr__(self, key):
         try:
@@ -187,13 +639,37 @@ class Model(dict, metaclass=ModelMetaclass):
     def get_value(self, key):
         return getattr(self, key, None)
 
+    # 由数据库返回的一行构造Model，并做字段值转换
+    @classmethod
+    def from_row(cls, row):
+        for k, f in cls.__converters__.items():
+            if k in row:
+                row[k] = f.from_db(row[k])
+        model = cls(**row)
+        model._mark_clean()
+        return model
+
+    def _mark_clean(self):
+        self._dirty.clear()
+        object.__setattr__(self, '_loaded', True)
+
+    # 修改过、尚未写入数据库的字段
+    def dirty_fields(self):
+        return [k for k in self.__fields__ if k in self._dirty]
+
+    # 写入数据库时使用的值
+    def get_db_value(self, key, default=False):
+        value = self.get_value_default(key) if default else self.get_value(key)
+        field = self.__converters__.get(key)
+        return value if field is None else field.to_db(value)
+
     def get_value_default(self, key):
         value = getattr(self, key, None)
         if value is None:
             field = self.__mappings__[key]
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.error('using default value for %s:%s' % (key, str(value)))
+                logging.debug('using default value for %s:%s' % (key, str(value)))
                 setattr(self, key, value)
         return value
 
@@ -221,47 +697,177 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        rs = await cached_select(cls.__table__, cls._cache_ttl(kw.get('cache', True)), ' '.join(sql), args)
+        return [cls.from_row(dict(r)) for r in rs]
 
     # 根据主键查找
     @classmethod
-    async def find(cls, primary_key):
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), primary_key, 1)
+    async def find(cls, primary_key, cache=True):
+        field = cls.__mappings__[cls.__primary_key__]
+        try:
+            primary_key = field.to_db(primary_key)
+        except ValueError:
+            # 如/blog/abc这样无法转换的主键，不可能存在
+            return None
+        rs = await cached_select(cls.__table__, cls._cache_ttl(cache),
+                                 '%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [primary_key], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls.from_row(dict(rs[0]))
 
     # 保存
     async def save(self):
         # 将属性值组合成list
-        args = list(map(self.get_value_default, self.__fields__))
-        args.append(self.get_value_default(self.__primary_key__))
+        args = [self.get_db_value(k, default=True) for k in self.__fields__]
+        args.append(self.get_db_value(self.__primary_key__, default=True))
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.error('failed to insert record: affected rows: %s' % rows)
+        self._mark_clean()
+        _notify('save', self)
 
-    # 更新
+    # 更新：从数据库读出的对象只写修改过的字段，没有修改则不访问数据库；
+    # 不是读出来的对象不知道哪些字段变了，写全部字段
+    # 声明了__version__的Model，条件中带上读出时的版本号，并把版本号加1，被别人抢先更新时抛出StaleObjectError
     async def update(self):
-        args = list(map(self.get_value, self.__fields__))
-        args.append(self.get_value(self.__primary_key__))
-        rows = await execute(self.__update__, args)
-        if rows != 1:
+        fields = self.dirty_fields() if self._loaded else list(self.__fields__)
+        version = self.__version__
+        if version is not None and version in fields:
+            fields.remove(version)
+        if not fields:
+            logging.debug('nothing to update: %s' % self.get_value(self.__primary_key__))
+            return
+        sets = ['`%s`=?' % f for f in fields]
+        args = [self.get_db_value(f) for f in fields]
+        where = ['`%s`=?' % self.__primary_key__]
+        args.append(self.get_db_value(self.__primary_key__))
+        if version is not None:
+            current = self.get_value(version) or 0
+            sets.append('`%s`=`%s`+1' % (version, version))
+            where.append('`%s`=?' % version)
+            args.append(current)
+        rows = await execute('update `%s` set %s where %s' % (self.__table__, ', '.join(sets), ' and '.join(where)),
+                             args)
+        if version is not None:
+            if rows == 0:
+                raise StaleObjectError('%s %s has been modified (version %s)' % (
+                    self.__table__, self.get_value(self.__primary_key__), current))
+            dict.__setitem__(self, version, current + 1)
+        elif rows != 1:
             logging.error('failed to update by primary key: affected rows: %s' % rows)
+        self._mark_clean()
+        _notify('update', self)
 
     # 删除
     async def remove(self):
-        args = [self.get_value(self.__primary_key__)]
+        args = [self.get_db_value(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.error('failed to remove by primary key: affected rows: %s' % rows)
+        _notify('remove', self)
+
+    # 计数器：在数据库中原子地给field加上delta，不经过乐观锁，不需要先读出对象；返回新值
+    # 只增加计数器的版本号（见counter_key），变更监听收到'increment'事件，对象只有主键和该字段
+    # 因此缓存中的整行数据里计数器的值可能是旧的，显示时用find_counter读取
+    @classmethod
+    async def increment(cls, primary_key, field, delta=1):
+        pk = cls.__primary_key__
+        converter = cls.__converters__.get(pk)
+        key = primary_key if converter is None else converter.to_db(primary_key)
+        rows = await execute('update `%s` set `%s`=`%s`+? where `%s`=?' % (cls.__table__, field, field, pk),
+                             [delta, key])
+        if rows != 1:
+            logging.error('failed to increment %s by primary key: affected rows: %s' % (field, rows))
+            return None
+        rs = await select('select `%s` from `%s` where `%s`=?' % (field, cls.__table__, pk), [key], 1)
+        value = rs[0][field] if rs else None
+        model = cls(**{pk: primary_key, field: value})
+        model._mark_clean()
+        _notify('increment', model)
+        return value
 
+    # 读取计数器字段的当前值，按计数器的版本号缓存：计数变化后立即失效，表的其它写入不影响
     @classmethod
-    async def find_number(cls, select_field, where=None, args=None):
+    async def find_counter(cls, primary_key, field, cache=True):
+        pk = cls.__primary_key__
+        try:
+            key = cls.__mappings__[pk].to_db(primary_key)
+        except ValueError:
+            return None
+        rs = await cached_select(counter_key(cls.__table__), cls._cache_ttl(cache),
+                                 'select `%s` from `%s` where `%s`=?' % (field, cls.__table__, pk), [key], 1)
+        return rs[0][field] if rs else None
+
+    # 一次查询读取多行计数器字段的当前值，返回{主键: 值}
+    @classmethod
+    async def find_counters(cls, primary_keys, field, cache=True):
+        pk = cls.__primary_key__
+        keys = [cls.__mappings__[pk].to_db(k) for k in primary_keys]
+        if not keys:
+            return {}
+        rs = await cached_select(counter_key(cls.__table__), cls._cache_ttl(cache),
+                                 'select `%s`, `%s` from `%s` where `%s` in (%s)' % (
+                                     pk, field, cls.__table__, pk, ', '.join('?' * len(keys))), keys)
+        return {cls.__mappings__[pk].from_db(r[pk]): r[field] for r in rs}
+
+    @classmethod
+    async def find_number(cls, select_field, where=None, args=None, cache=True):
         # _num_代表别名
         sql = ['select %s _num_ from `%s`' % (select_field, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await cached_select(cls.__table__, cls._cache_ttl(cache), ' '.join(sql), args, 1)
         return rs[0]['_num_']
+
+    # 分页查询，一次往返同时取回当前页的数据和总数，返回(models, total)
+    # 客户端传回之前拿到的total时不再计算总数；
+    # 支持窗口函数(MySQL 8)时用count(*) over()，否则用SQL_CALC_FOUND_ROWS + FOUND_ROWS()
+    @classmethod
+    async def find_page(cls, page_index, page_size, where=None, args=None, order_by=None, total=None):
+        offset = page_size * (page_index - 1)
+        if total is not None:
+            if offset >= total:
+                return [], total
+            return await cls.find_all(where, args, order_by=order_by, limit=(offset, page_size)), total
+        args = list(args or [])
+        window = window_functions()
+        select_sql = cls.__select__
+        if window:
+            select_sql = '%s, count(*) over() _total_ from `%s`' % (select_sql.split(' from `')[0], cls.__table__)
+        else:
+            select_sql = select_sql.replace('select ', 'select SQL_CALC_FOUND_ROWS ', 1)
+        sql = [select_sql]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        if order_by:
+            sql.append('order by')
+            sql.append(order_by)
+        sql.append('limit ?, ?')
+        args.extend((offset, page_size))
+        if window:
+            rs = await cached_select(cls.__table__, cls._cache_ttl(), ' '.join(sql), args)
+            if rs:
+                total = rs[0]['_total_']
+            elif page_index == 1:
+                total = 0
+            else:
+                # 页码超出范围时取不到总数，单独查一次
+                total = await cls.find_number('count(*)', where, args[:-2])
+        else:
+            rs, total = await select_found_rows(' '.join(sql), args)
+        models = []
+        for r in rs:
+            r = dict(r)
+            r.pop('_total_', None)
+            models.append(cls.from_row(r))
+        return models, total
+
+    # 缓存时间：configs.cache.ttl中按表名配置的优先，其次是Model的__cache_ttl__
+    @classmethod
+    def _cache_ttl(cls, enabled=True):
+        conf = configs.get('cache', {})
+        if not enabled or not conf.get('enabled', True):
+            return 0
+        return conf.get('ttl', {}).get(cls.__table__, cls.__cache_ttl__)
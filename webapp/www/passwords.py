@@ -0,0 +1,112 @@
+"""
+口令哈希服务：使用慢速KDF（PBKDF2或scrypt），在专用的有界线程池中计算，不阻塞事件循环
+
+存储格式：
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+    scrypt$<n>$<r>$<p>$<salt>$<hash>
+    sha1$<salt>$<hash>          旧格式，salt为旧的用户id
+    <40位hex>                   最早的格式，sha1('用户id:口令')
+旧格式登录成功时自动重新哈希为新格式。
+"""
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from webapp.www.apis import APIError
+from webapp.www.config import configs
+
+_RE_LEGACY_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+
+_executor = None
+_semaphore = None
+_pending = 0
+
+
+def _config():
+    return configs.get('passwords', {})
+
+
+# hashlib的pbkdf2_hmac/scrypt计算时会释放GIL，用线程池即可并行
+def _get_executor():
+    global _executor, _semaphore
+    if _executor is None:
+        workers = _config().get('workers', 2)
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+        _semaphore = asyncio.Semaphore(workers)
+    return _executor
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), iterations).hex()
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024).hex()
+
+
+def _make_hash(password):
+    conf = _config()
+    salt = os.urandom(16).hex()
+    if conf.get('algorithm') == 'scrypt':
+        n, r, p = conf.get('scrypt_n', 2 ** 14), conf.get('scrypt_r', 8), conf.get('scrypt_p', 1)
+        return 'scrypt$%s$%s$%s$%s$%s' % (n, r, p, salt, _scrypt(password, salt, n, r, p))
+    iterations = conf.get('iterations', 200000)
+    return 'pbkdf2_sha256$%s$%s$%s' % (iterations, salt, _pbkdf2(password, salt, iterations))
+
+
+def _check_hash(stored, password):
+    parts = stored.split('$')
+    if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+        return hmac.compare_digest(parts[3], _pbkdf2(password, parts[2], int(parts[1])))
+    if parts[0] == 'scrypt' and len(parts) == 6:
+        return hmac.compare_digest(parts[5], _scrypt(password, parts[4], int(parts[1]), int(parts[2]),
+                                                     int(parts[3])))
+    return False
+
+
+def _legacy_sha1(salt, password):
+    return hashlib.sha1(('%s:%s' % (salt, password)).encode('utf-8')).hexdigest()
+
+
+def is_legacy(stored):
+    return bool(_RE_LEGACY_SHA1.match(stored)) or stored.startswith('sha1$')
+
+
+# 在线程池中执行慢速计算；同时在算的数量受workers限制，排队超过max_pending直接拒绝，登录风暴不会耗尽CPU
+async def _run(fn, *args):
+    global _pending
+    executor = _get_executor()
+    if _pending >= _config().get('max_pending', 32):
+        logging.warning('password hashing queue is full')
+        raise APIError('server:busy', 'password', 'Too many requests, please retry later.')
+    _pending += 1
+    try:
+        async with _semaphore:
+            return await asyncio.get_event_loop().run_in_executor(executor, fn, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password):
+    return await _run(_make_hash, password)
+
+
+# 校验口令，返回(是否正确, 需要写回的新哈希或None)
+async def verify_password(user, password):
+    stored = user.password or ''
+    if _RE_LEGACY_SHA1.match(stored):
+        ok = hmac.compare_digest(stored, _legacy_sha1(user.id, password))
+    elif stored.startswith('sha1$'):
+        _, salt, digest = stored.split('$', 2)
+        ok = hmac.compare_digest(digest, _legacy_sha1(salt, password))
+    else:
+        return await _run(_check_hash, stored, password), None
+    if not ok:
+        return False, None
+    return True, await hash_password(password)
@@ -3,10 +3,13 @@ create database awesome;
 use awesome;
 grant select, insert, update, delete on awesome.* to 'root:123456'@'localhost' identified by 'root:123456';
 
+-- 表结构由models.py中的声明生成（python -m webapp.www.ddl schema），与线上的差异用 python -m webapp.www.ddl diff 查看
+
+-- 已有数据库升级口令哈希长度：alter table users modify `password` varchar(200) not null;
 create table users (
-    `id` varchar(50) not null,
+    `id` bigint not null,
     `email` varchar(50) not null,
-    `password` varchar(50) not null,
+    `password` varchar(200) not null,
     `admin` bool not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
@@ -16,27 +19,37 @@ create table users (
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
+-- 已有数据库增加乐观锁版本号：alter table blogs add column `version` bigint not null default 0 after `content`;
+-- 已有数据库增加评论数：alter table blogs add column `comment_count` bigint not null default 0 after `version`;
+--     update blogs b set `comment_count`=(select count(*) from comments c where c.`blog_id`=b.`id`);
 create table blogs (
-    `id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+    `id` bigint not null,
+    `user_id` bigint not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `version` bigint not null default 0,
+    `comment_count` bigint not null default 0,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
+-- 已有数据库增加评论索引：alter table comments add key `idx_blog_id_created_at` (`blog_id`, `created_at`);
+-- 已有数据库增加评论HTML：alter table comments add column `html_content` mediumtext not null after `content`;
+--     旧评论的html_content为空，显示时再转换
 create table comments (
-    `id` varchar(50) not null,
-    `blog_id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+    `id` bigint not null,
+    `blog_id` bigint not null,
+    `user_id` bigint not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
     `created_at` real not null,
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
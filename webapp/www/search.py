@@ -0,0 +1,429 @@
+"""
+进程内的全文搜索：Blog、Comment的倒排索引，BM25排序
+
+- 启动时流式批量建索引，之后通过orm的变更监听随save/update/remove增量更新
+- 分词：拉丁字母/数字按单词，中日韩文字按二元组(bigram)
+- 索引定期在线程池中快照到磁盘，重启时mmap快照文件，倒排表在第一次用到时才解码，不用重建；
+  快照与数据库的指纹（行数、id之和、blog版本号之和）不一致时重建
+"""
+
+import asyncio
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+
+from webapp.www import jobs, orm
+from webapp.www.config import configs
+from webapp.www.models import Blog, Comment
+
+_RE_CJK = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+_RE_TOKEN = re.compile(r'[0-9a-z\u00c0-\u024f]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+_MAGIC = b'AWSIDX2\n'
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    tokens = []
+    if not text:
+        return tokens
+    for m in _RE_TOKEN.finditer(text.lower()):
+        run = m.group(0)
+        if _RE_CJK.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class SearchIndex(object):
+    def __init__(self):
+        # 文档编号 -> [kind, id, title, ref, length, version]，删除后置为None
+        self.docs = []
+        # (kind, id) -> 文档编号
+        self.doc_index = {}
+        # 词 -> {文档编号: 词频}
+        self.postings = {}
+        self.total_length = 0
+        self.live = 0
+        self.built_at = 0.0
+        self.dirty = False
+        # mmap的快照：词 -> (偏移, 个数)
+        self._mm = None
+        self._snapshot_terms = {}
+
+    def _load_postings(self, term, cache=True):
+        p = self.postings.get(term)
+        if p is not None:
+            return p
+        loc = self._snapshot_terms.get(term)
+        if loc is None:
+            return None
+        offset, count = loc
+        arr = array('I')
+        arr.frombytes(self._mm[offset:offset + count * 8])
+        p = dict(zip(arr[0::2], arr[1::2]))
+        if cache:
+            self.postings[term] = p
+            del self._snapshot_terms[term]
+        return p
+
+    def add(self, kind, id, title, ref, text, version=0):
+        self.remove(kind, id)
+        tokens = tokenize(text)
+        doc_no = len(self.docs)
+        self.docs.append([kind, id, title, ref, len(tokens), version])
+        self.doc_index[(kind, id)] = doc_no
+        self.total_length += len(tokens)
+        self.live += 1
+        counts = {}
+        for t in tokens:
+            counts[t] = counts.get(t, 0) + 1
+        for t, tf in counts.items():
+            p = self._load_postings(t)
+            if p is None:
+                p = self.postings[t] = {}
+            p[doc_no] = tf
+        self.dirty = True
+
+    # 删除只标记文档，倒排表中的残留在打分时跳过，保存快照时清理
+    def remove(self, kind, id):
+        doc_no = self.doc_index.pop((kind, id), None)
+        if doc_no is None:
+            return
+        self.total_length -= self.docs[doc_no][4]
+        self.live -= 1
+        self.docs[doc_no] = None
+        self.dirty = True
+
+    def search(self, query, limit=20, offset=0):
+        terms = set(tokenize(query))
+        if not terms or not self.live:
+            return []
+        n = self.live
+        avgdl = self.total_length / n or 1.0
+        scores = {}
+        for t in terms:
+            p = self._load_postings(t)
+            if not p:
+                continue
+            df = len(p)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for doc_no, tf in p.items():
+                doc = self.docs[doc_no]
+                if doc is None:
+                    continue
+                s = idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * doc[4] / avgdl))
+                scores[doc_no] = scores.get(doc_no, 0.0) + s
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[offset:offset + limit]
+        results = []
+        for doc_no, score in ranked:
+            kind, id, title, ref = self.docs[doc_no][:4]
+            results.append(dict(kind=kind, id=id, title=title, blog_id=ref or id, score=round(score, 4)))
+        return results
+
+    # 保存快照用的数据副本：在事件循环中执行，只复制文档列表和内存中的倒排表，
+    # 编码、写文件由write_snapshot在线程中完成，之后的add/remove不影响这份副本
+    def snapshot(self):
+        postings = {t: dict(p) for t, p in self.postings.items()}
+        self.dirty = False
+        return list(self.docs), postings, dict(self._snapshot_terms), self._mm, self.built_at
+
+    # 与数据库比对用的指纹：每种文档的个数、id之和、版本号之和
+    # id不会重复使用，删除后再新增也会改变id之和；blog每次编辑版本号加1
+    def fingerprint(self):
+        fp = {}
+        for doc in self.docs:
+            if doc is not None:
+                count, ids, versions = fp.get(doc[0], (0, 0, 0))
+                fp[doc[0]] = (count + 1, ids + int(doc[1]), versions + doc[5])
+        return fp
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('invalid search snapshot: %s' % path)
+        start = len(_MAGIC)
+        header_len = struct.unpack('<Q', mm[start:start + 8])[0]
+        header = json.loads(mm[start + 8:start + 8 + header_len].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('search snapshot byte order mismatch: %s' % path)
+        base = start + 8 + header_len
+        index._mm = mm
+        index._snapshot_terms = {t: (base + off, count) for t, (off, count) in header['terms'].items()}
+        index.docs = header['docs']
+        for doc_no, doc in enumerate(index.docs):
+            index.doc_index[(doc[0], doc[1])] = doc_no
+            index.total_length += doc[4]
+        index.live = len(index.docs)
+        index.built_at = header['built_at']
+        return index
+
+
+# 快照格式：magic + 头部长度(8字节) + 头部JSON + 倒排表(uint32的文档编号、词频交替排列)
+# 保存时去掉已删除的文档并重新编号；snapshot为SearchIndex.snapshot()的返回值，不访问事件循环中的数据
+def write_snapshot(snapshot, path):
+    docs, postings, snapshot_terms, mm, built_at = snapshot
+    renumber = {}
+    live = []
+    for doc_no, doc in enumerate(docs):
+        if doc is not None:
+            renumber[doc_no] = len(live)
+            live.append(doc)
+    terms = {}
+    body = []
+    offset = 0
+    for term in list(postings.keys()) + list(snapshot_terms.keys()):
+        if term in postings:
+            items = postings[term].items()
+        else:
+            start, count = snapshot_terms[term]
+            stored = array('I')
+            stored.frombytes(mm[start:start + count * 8])
+            items = zip(stored[0::2], stored[1::2])
+        arr = array('I')
+        for doc_no, tf in items:
+            if doc_no in renumber:
+                arr.append(renumber[doc_no])
+                arr.append(tf)
+        if not arr:
+            continue
+        data = arr.tobytes()
+        terms[term] = [offset, len(arr) // 2]
+        body.append(data)
+        offset += len(data)
+    header = json.dumps(dict(docs=live, terms=terms, built_at=built_at,
+                             byteorder=sys.byteorder), ensure_ascii=False).encode('utf-8')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for data in body:
+            f.write(data)
+    os.replace(tmp, path)
+    logging.info('search index saved: %s docs, %s terms -> %s' % (len(live), len(terms), path))
+
+
+_index = SearchIndex()
+_loader = None
+_saver = None
+# 加载、重建索引期间收到的变更(kind, id, removed)，None表示没有在重建
+_replay = None
+# 同一时间只有一个线程写快照文件
+_save_lock = None
+
+
+def _config():
+    return configs.get('search', {})
+
+
+def _blog_doc(blog):
+    # 标题权重加倍
+    text = '%s %s %s %s' % (blog.name, blog.name, blog.summary or '', blog.content or '')
+    return 'blog', blog.id, blog.name, None, text, blog.version or 0
+
+
+def _comment_doc(comment):
+    content = comment.content or ''
+    return 'comment', comment.id, content[:50], comment.blog_id, content
+
+
+def index_model(model, index=None):
+    index = index or _index
+    if isinstance(model, Blog):
+        index.add(*_blog_doc(model))
+    elif isinstance(model, Comment):
+        index.add(*_comment_doc(model))
+
+
+def remove_model(model, index=None):
+    index = index or _index
+    if isinstance(model, Blog):
+        index.remove('blog', model.id)
+    elif isinstance(model, Comment):
+        index.remove('comment', model.id)
+
+
+# 写入后只提交任务，分词、建索引在任务队列中完成，不增加写请求的延迟
+def on_change(event, model):
+    # Blog.increment只改计数，不影响索引
+    if event == 'increment':
+        return
+    if isinstance(model, (Blog, Comment)):
+        jobs.enqueue('search.index', priority='low', kind=model.__table__, id=str(model.id),
+                     removed=event == 'remove')
+
+
+# 其它worker的写入（见orm.subscribe_remote），同样按数据库中的当前数据更新本进程的索引
+def on_remote_change(event, name):
+    table, _, id = name.partition(':')
+    if event == 'increment' or table not in (Blog.__table__, Comment.__table__):
+        return
+    jobs.enqueue('search.index', priority='low', kind=table, id=id, removed=event == 'remove')
+
+
+@jobs.register('search.index')
+async def index_job(kind, id, removed):
+    if _replay is not None:
+        _replay.append((kind, id, removed))
+    await _apply(_index, kind, id, removed)
+
+
+# 按数据库中的当前数据更新index中的一个文档
+async def _apply(index, kind, id, removed):
+    model = Blog if kind == Blog.__table__ else Comment
+    row = None if removed else await model.find(id, cache=False)
+    if row is None:
+        remove_model(model(id=id), index)
+    else:
+        index_model(row, index)
+
+
+# 按主键分批流式读取，避免一次把所有content读进内存
+async def _stream(model, where=None, args=None):
+    batch = _config().get('batch', 500)
+    last = None
+    while True:
+        clauses = [where] if where else []
+        params = list(args or [])
+        if last is not None:
+            clauses.append('`id`>?')
+            params.append(last)
+        rows = await model.find_all(' and '.join(clauses) or None, params, order_by='id', limit=batch, cache=False)
+        for row in rows:
+            yield row
+        if len(rows) < batch:
+            return
+        last = rows[-1].id
+
+
+async def build(index, since=None):
+    where, args = ('`created_at`>?', [since]) if since else (None, None)
+    count = 0
+    start = time.time()
+    for model in (Blog, Comment):
+        async for row in _stream(model, where, args):
+            index_model(row, index)
+            count += 1
+            if count % 1000 == 0:
+                # 让出事件循环，建索引时不影响正常请求
+                await asyncio.sleep(0)
+    index.built_at = start
+    logging.info('search index: %s docs indexed in %.2fs' % (count, time.time() - start))
+
+
+# 数据库中的指纹，与SearchIndex.fingerprint对应
+async def db_fingerprint():
+    fp = {}
+    for kind, model in (('blog', Blog), ('comment', Comment)):
+        versions = 'sum(`version`)' if kind == 'blog' else '0'
+        rs = await orm.select('select count(`id`) as n, sum(`id`) as ids, %s as versions from `%s`' % (
+            versions, model.__table__), [])
+        if rs and rs[0]['n']:
+            fp[kind] = (int(rs[0]['n']), int(rs[0]['ids']), int(rs[0]['versions'] or 0))
+    return fp
+
+
+# mmap加载快照，补上快照之后新增的数据；与数据库的指纹不一致（编辑、删除过）时返回None
+async def _load_snapshot(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        index = SearchIndex.load(path)
+        await build(index, since=index.built_at)
+        expected = await db_fingerprint()
+        if index.fingerprint() == expected:
+            return index
+        logging.warning('search snapshot out of date (%s, database %s), rebuilding' % (index.fingerprint(), expected))
+    except Exception as e:
+        logging.exception(e)
+    return None
+
+
+# 有快照就加载，否则重建；新索引在后台准备好后才替换_index
+# 期间的变更由index_job记入_replay，替换后按数据库中的当前数据在新索引上重放
+async def load_or_build():
+    global _index, _replay
+    _replay = []
+    try:
+        index = await _load_snapshot(_config().get('snapshot'))
+        if index is None:
+            index = SearchIndex()
+            await build(index)
+        _index = index
+        while _replay:
+            changes = {(kind, id): removed for kind, id, removed in _replay}
+            del _replay[:]
+            for (kind, id), removed in changes.items():
+                await _apply(index, kind, id, removed)
+    finally:
+        _replay = None
+    await save()
+
+
+# 取副本后在线程池中写快照，不阻塞事件循环；写失败时保留dirty，下次再写
+async def save():
+    global _save_lock
+    path = _config().get('snapshot')
+    if not path:
+        return
+    if _save_lock is None:
+        _save_lock = asyncio.Lock()
+    async with _save_lock:
+        if not _index.dirty:
+            return
+        index = _index
+        snapshot = index.snapshot()
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, write_snapshot, snapshot, path)
+        except BaseException:
+            index.dirty = True
+            raise
+
+
+async def _save_periodically():
+    while True:
+        await asyncio.sleep(_config().get('snapshot_interval', 300))
+        try:
+            await save()
+        except Exception as e:
+            logging.exception(e)
+
+
+def search(query, limit=20, offset=0):
+    return _index.search(query, limit, offset)
+
+
+# 在app启动时调用：注册变更监听，后台加载/建立索引并定期快照；关闭时停止这两个任务并写最后一次快照
+def init(app):
+    global _loader, _saver
+    if not _config().get('enabled', True):
+        return
+    orm.add_listener(on_change)
+    orm.subscribe_remote(on_remote_change)
+    _loader = asyncio.ensure_future(load_or_build())
+    _saver = asyncio.ensure_future(_save_periodically())
+
+    async def on_shutdown(app):
+        for task in (_loader, _saver):
+            task.cancel()
+        await asyncio.gather(_loader, _saver, return_exceptions=True)
+        await save()
+
+    app.on_shutdown.append(on_shutdown)
@@ -0,0 +1,269 @@
+"""
+多进程共享的缓存：同一台机器上的所有worker进程mmap同一个文件
+
+- 表版本号存放在共享内存中，任何一个worker写表后，其它worker下次读缓存时立刻看到新版本号，旧条目随即失效
+- 缓存条目放在固定数量、固定大小的槽里，内存总量按整台机器计算而不是按进程
+- 写入时用flock加锁；读取不加锁，用每个槽的序号（seqlock）和crc32校验避免读到写了一半的数据
+- 另有一个Unix数据报socket组成的本机广播通道：orm写入后广播(事件, 表:主键)，
+  其它worker据此更新各自进程内的数据（搜索索引、首页的物化视图）
+"""
+
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import pickle
+import socket
+import struct
+import time
+import zlib
+
+from webapp.www import orm
+
+_MAGIC = b'AWSHMC1\0'
+# 头部：magic | 槽数 | 槽大小
+_HEADER = struct.Struct('<8sII')
+# 表版本号区：(表名hash, 版本号) * VERSION_SLOTS
+_VERSION = struct.Struct('<QQ')
+VERSION_SLOTS = 64
+# 槽头：key hash | 序号（奇数表示正在写） | 过期时间 | 数据长度 | crc32
+_SLOT = struct.Struct('<QQdII')
+# 同一个key最多探测的槽数
+PROBE = 4
+
+
+def _hash(key):
+    return zlib.crc32(key) | (zlib.adler32(key) << 32) or 1
+
+
+class SharedCache(object):
+    def __init__(self, path, slots=16384, slot_size=4096, socket_dir=None):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.too_large = 0
+        self._versions_offset = _HEADER.size
+        self._slots_offset = self._versions_offset + _VERSION.size * VERSION_SLOTS
+        size = self._slots_offset + slots * slot_size
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+            magic, n, ss = _HEADER.unpack_from(self._mm, 0)
+            if magic != _MAGIC or n != slots or ss != slot_size:
+                # 新文件或布局变了，整体清零
+                self._mm[:size] = bytes(size)
+                _HEADER.pack_into(self._mm, 0, _MAGIC, slots, slot_size)
+        self._socket_dir = socket_dir
+        self._sock = None
+        self._subscribers = []
+
+    # 整台机器范围的写锁
+    def _locked(self):
+        fd = self._fd
+
+        class _Lock(object):
+            def __enter__(self):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+            def __exit__(self, *exc):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+        return _Lock()
+
+    # -------- 表版本号 --------
+
+    def _version_slot(self, table, create=False):
+        h = _hash(table.encode('utf-8'))
+        start = h % VERSION_SLOTS
+        for i in range(VERSION_SLOTS):
+            offset = self._versions_offset + ((start + i) % VERSION_SLOTS) * _VERSION.size
+            slot_hash, _ = _VERSION.unpack_from(self._mm, offset)
+            if slot_hash == h:
+                return offset
+            if slot_hash == 0:
+                if create:
+                    _VERSION.pack_into(self._mm, offset, h, 0)
+                    return offset
+                return None
+        raise RuntimeError('too many tables in shared cache')
+
+    def get_version(self, table):
+        offset = self._version_slot(table)
+        if offset is None:
+            return 0
+        return _VERSION.unpack_from(self._mm, offset)[1]
+
+    def bump_version(self, table):
+        with self._locked():
+            offset = self._version_slot(table, create=True)
+            h, version = _VERSION.unpack_from(self._mm, offset)
+            _VERSION.pack_into(self._mm, offset, h, version + 1)
+        return version + 1
+
+    # -------- 缓存条目 --------
+
+    def _slot_offset(self, index):
+        return self._slots_offset + (index % self.slots) * self.slot_size
+
+    def _read_slot(self, offset, h, key):
+        slot_hash, seq, expires, length, crc = _SLOT.unpack_from(self._mm, offset)
+        if slot_hash != h or seq & 1:
+            return None
+        start = offset + _SLOT.size
+        data = self._mm[start:start + length]
+        if _SLOT.unpack_from(self._mm, offset)[1] != seq or zlib.crc32(data) != crc:
+            # 读的过程中被改写了
+            return None
+        if expires and expires < time.time():
+            return None
+        key_len = struct.unpack_from('<H', data, 0)[0]
+        if data[2:2 + key_len] != key:
+            return None
+        return pickle.loads(data[2 + key_len:])
+
+    def get(self, key, default=None):
+        h = _hash(key)
+        for i in range(PROBE):
+            value = self._read_slot(self._slot_offset(h + i), h, key)
+            if value is not None:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        payload = struct.pack('<H', len(key)) + key + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.slot_size - _SLOT.size:
+            self.too_large += 1
+            return False
+        h = _hash(key)
+        now = time.time()
+        with self._locked():
+            # 优先用同一个key的槽，其次空槽或已过期的槽，否则替换最早过期的
+            target, target_expires = None, None
+            for i in range(PROBE):
+                offset = self._slot_offset(h + i)
+                slot_hash, seq, expires, _, _ = _SLOT.unpack_from(self._mm, offset)
+                if slot_hash == h or slot_hash == 0 or (expires and expires < now):
+                    target = offset
+                    break
+                if target is None or (expires or float('inf')) < target_expires:
+                    target, target_expires = offset, expires or float('inf')
+            seq = _SLOT.unpack_from(self._mm, target)[1]
+            _SLOT.pack_into(self._mm, target, 0, seq + 1, 0.0, 0, 0)
+            start = target + _SLOT.size
+            self._mm[start:start + len(payload)] = payload
+            _SLOT.pack_into(self._mm, target, h, seq + 2, now + ttl if ttl else 0.0, len(payload),
+                            zlib.crc32(payload))
+        self.sets += 1
+        return True
+
+    def delete(self, key):
+        h = _hash(key)
+        with self._locked():
+            for i in range(PROBE):
+                offset = self._slot_offset(h + i)
+                slot_hash, seq = _SLOT.unpack_from(self._mm, offset)[:2]
+                if slot_hash == h:
+                    _SLOT.pack_into(self._mm, offset, 0, seq + 2, 0.0, 0, 0)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(slots=self.slots, slot_size=self.slot_size, bytes=self.slots * self.slot_size,
+                    hits=self.hits, misses=self.misses, hit_ratio=self.hits / total if total else 0.0,
+                    sets=self.sets, too_large=self.too_large)
+
+    # -------- 本机失效广播 --------
+
+    # 每个worker绑定<socket_dir>/<pid>.sock，收到的消息交给subscribe注册的回调fn(kind, name)
+    def start_listener(self, loop):
+        if not self._socket_dir:
+            return
+        os.makedirs(self._socket_dir, exist_ok=True)
+        path = os.path.join(self._socket_dir, '%s.sock' % os.getpid())
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(path)
+        self._sock.setblocking(False)
+        loop.add_reader(self._sock.fileno(), self._on_message)
+
+    def subscribe(self, fn):
+        self._subscribers.append(fn)
+
+    def _on_message(self):
+        while True:
+            try:
+                data = self._sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            kind, _, name = data.decode('utf-8').partition(':')
+            for fn in self._subscribers:
+                try:
+                    fn(kind, name)
+                except Exception as e:
+                    logging.exception(e)
+
+    def publish(self, kind, name):
+        if self._sock is None:
+            return
+        message = ('%s:%s' % (kind, name)).encode('utf-8')[:4096]
+        me = self._sock.getsockname()
+        for path in glob.glob(os.path.join(self._socket_dir, '*.sock')):
+            if path == me:
+                continue
+            try:
+                self._sock.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 对应的worker已经退出
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except (BlockingIOError, OSError) as e:
+                logging.warning('shared cache: failed to notify %s: %s' % (path, e))
+
+    def close(self, loop=None):
+        if self._sock is not None:
+            if loop is not None:
+                loop.remove_reader(self._sock.fileno())
+            path = self._sock.getsockname()
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._mm.close()
+        os.close(self._fd)
+
+
+_shared = None
+
+
+def get_shared():
+    return _shared
+
+
+# 在app启动时调用：打开共享缓存，启动失效广播的监听，并让orm的表版本号、查询缓存使用它
+def init(app, loop, conf):
+    global _shared
+    if not conf.get('enabled', False):
+        return None
+    _shared = SharedCache(conf['path'], conf.get('slots', 16384), conf.get('slot_size', 4096),
+                          conf.get('socket_dir'))
+    _shared.start_listener(loop)
+    orm.set_shared_cache(_shared)
+
+    async def on_shutdown(app):
+        _shared.close(loop)
+
+    app.on_shutdown.append(on_shutdown)
+    return _shared
@@ -339,6 +339,15 @@ function getJSON(url, data, callback) {
     _httpJSON('GET', url, data, callback);
 }
 
+// 一次请求调用多个GET api，paths如['/api/blogs?page=1', '/api/users']，callback(err, [{path, status, body, etag}])
+// path也可以是{path: ..., etag: ...}，未修改时对应结果的status为304
+function batchJSON(paths, callback) {
+    var requests = $.map(paths, function (p) {
+        return typeof (p)==='string' ? {path: p} : p;
+    });
+    _httpJSON('POST', '/api/batch', {requests: requests}, callback);
+}
+
 function postJSON(url, data, callback) {
     if (arguments.length===2) {
         callback = data;
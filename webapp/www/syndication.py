@@ -0,0 +1,167 @@
+"""
+Atom/RSS订阅：/feed.atom、/feed.rss
+
+- 每篇blog的<entry>/<item>渲染一次（markdown转换、XML转义），按(id, version)缓存，编辑后才重新渲染
+- 整个文档预先编码为bytes，连同ETag、Last-Modified一起保存；blogs表版本号不变时直接返回，不查数据库
+- 带If-None-Match/If-Modified-Since的轮询在版本号不变时返回304
+- blog写入后通过任务队列在后台重建，订阅请求一般不需要等待重建；同时只有一个重建，其它请求等待同一个结果
+- 链接中的站点地址取自configs.feed.url（未设置时用configs.server），不取请求的Host：
+  文档对所有人缓存，伪造的Host不能写进去
+"""
+
+import asyncio
+import contextvars
+import hashlib
+import logging
+import time
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from xml.sax.saxutils import escape, quoteattr
+
+from aiohttp import web
+
+from webapp.www import jobs, orm
+from webapp.www.config import configs
+from webapp.www.models import Blog
+
+CONTENT_TYPES = {
+    'atom': 'application/atom+xml; charset=utf-8',
+    'rss': 'application/rss+xml; charset=utf-8',
+}
+
+# (blog id, version) -> (updated, atom entry, rss item)
+_entries = {}
+# kind -> (body, etag, last_modified)
+_documents = {}
+_version = None
+_site = None
+_rebuilding = None
+
+
+def _config():
+    return configs.get('feed', {})
+
+
+def _site_url():
+    url = _config().get('url')
+    if url:
+        return url.rstrip('/')
+    return 'http://%s:%s' % (configs.server.host, configs.server.port)
+
+
+def _rfc3339(t):
+    return datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _render_entry(blog, site, updated):
+    # handlers引用了本模块，在这里再导入
+    from webapp.www.handlers import markdown
+    link = '%s/blog/%s' % (site, blog.id)
+    html = markdown(blog.content)
+    atom = ('<entry><title>%s</title><link href=%s/><id>%s</id><published>%s</published><updated>%s</updated>'
+            '<author><name>%s</name></author><summary>%s</summary><content type="html">%s</content></entry>' % (
+                escape(blog.name), quoteattr(link), escape(link), _rfc3339(blog.created_at), _rfc3339(updated),
+                escape(blog.user_name), escape(blog.summary), escape(html)))
+    rss = ('<item><title>%s</title><link>%s</link><guid isPermaLink="true">%s</guid><pubDate>%s</pubDate>'
+           '<author>%s</author><description>%s</description></item>' % (
+               escape(blog.name), escape(link), escape(link), formatdate(blog.created_at, usegmt=True),
+               escape(blog.user_name), escape(html)))
+    return updated, atom, rss
+
+
+def _document(kind, site, entries, last_modified):
+    title = escape(_config().get('title', 'Awesome Python Webapp'))
+    if kind == 'atom':
+        xml = ('<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">'
+               '<title>%s</title><link href=%s/><link rel="self" href=%s/><id>%s/</id><updated>%s</updated>%s</feed>' % (
+                   title, quoteattr(site + '/'), quoteattr(site + '/feed.atom'), escape(site),
+                   _rfc3339(last_modified), ''.join(e[1] for e in entries)))
+    else:
+        xml = ('<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel><title>%s</title>'
+               '<link>%s/</link><description>%s</description><lastBuildDate>%s</lastBuildDate>%s</channel></rss>' % (
+                   title, escape(site), title, formatdate(last_modified, usegmt=True),
+                   ''.join(e[2] for e in entries)))
+    body = xml.encode('utf-8')
+    return body, '"%s"' % hashlib.sha1(body).hexdigest()[:24], last_modified
+
+
+# 查询最新的blog，只渲染新增或编辑过的条目，重新拼接两种文档
+async def rebuild():
+    global _version, _site
+    version = orm.table_version(Blog.__table__)
+    site = _site_url()
+    if site != _site:
+        _entries.clear()
+    blogs = await Blog.find_all(order_by='created_at desc', limit=_config().get('size', 20), cache=False)
+    entries = []
+    keep = {}
+    for blog in blogs:
+        key = (blog.id, blog.version)
+        entry = _entries.get(key)
+        if entry is None:
+            # 没有修改时间字段，编辑过的条目以重新渲染的时间作为更新时间
+            entry = _render_entry(blog, site, blog.created_at if not blog.version else time.time())
+        keep[key] = entry
+        entries.append(entry)
+    _entries.clear()
+    _entries.update(keep)
+    last_modified = max([e[0] for e in entries] or [0])
+    for kind in CONTENT_TYPES:
+        _documents[kind] = _document(kind, site, entries, last_modified)
+    _version = version
+    _site = site
+    logging.info('feed rebuilt with %s entries' % len(entries))
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return any(tag.strip() in (etag, '*') for tag in if_none_match.split(','))
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+# 同时只进行一个重建，并发的请求等待同一个结果
+# 在空的上下文中创建任务，不受发起请求的截止时间影响；shield让某个请求被取消时不会取消共用的重建
+def _rebuild_once():
+    global _rebuilding
+    if _rebuilding is None or _rebuilding.done():
+        _rebuilding = contextvars.Context().run(asyncio.ensure_future, rebuild())
+    return asyncio.shield(_rebuilding)
+
+
+async def feed_response(request, kind):
+    if _version != orm.table_version(Blog.__table__) or kind not in _documents:
+        await _rebuild_once()
+    body, etag, last_modified = _documents[kind]
+    headers = {'ETag': etag, 'Last-Modified': formatdate(last_modified, usegmt=True),
+               'Cache-Control': 'public, max-age=%s' % _config().get('max_age', 300)}
+    if _not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=headers)
+    headers['Content-Type'] = CONTENT_TYPES[kind]
+    return web.Response(body=body, headers=headers)
+
+
+# blog写入后在后台重建，下一次订阅请求直接使用新文档
+def on_change(event, model):
+    # Blog.increment只改评论数，订阅中没有这个字段
+    if event == 'increment':
+        return
+    if isinstance(model, Blog) and _documents:
+        jobs.enqueue('syndication.rebuild')
+
+
+# site参数是旧版本提交的任务中的，已不使用
+@jobs.register('syndication.rebuild')
+async def rebuild_job(site=None):
+    if _version != orm.table_version(Blog.__table__):
+        await _rebuild_once()
+
+
+def init(app):
+    orm.add_listener(on_change)